@@ -0,0 +1,65 @@
+"""Generate a rumble database filled with synthetic users, rooms and messages
+
+    python benchmarks/generate_db.py bench.db --users 1000 --rooms 100 --messages 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+
+script_dir = os.path.dirname(__file__)
+schema_file = os.path.join(script_dir, '..', 'rumble_server', 'rumble_schema.sql')
+
+sys.path.insert(0, os.path.join(script_dir, '..'))
+from rumble_server import timeutil
+
+
+def generate(db_path, users, rooms, messages, seed=0):
+    """Create db_path from the schema and fill it
+
+    Messages are spread at random over the rooms, one second apart, ending now.
+    """
+    if os.path.isfile(db_path):
+        os.remove(db_path)
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executescript(open(schema_file).read())
+        conn.execute("DELETE FROM room")
+        conn.executemany("INSERT INTO user (name, password, handle) VALUES(?, ?, ?)",
+                         (('user{}'.format(i), 'password', 'handle{}'.format(i))
+                          for i in xrange(users)))
+        conn.executemany("INSERT INTO room (name) VALUES(?)",
+                         (('room{}'.format(i),) for i in xrange(rooms)))
+
+        start = timeutil.now() // 1000000 * 1000000 - messages * 1000000
+
+        def rows():
+            seqs = [0] * (rooms + 1)
+            for i in xrange(messages):
+                room_id = rnd.randint(1, rooms)
+                seqs[room_id] += 1
+                yield (room_id,
+                       rnd.randint(1, users),
+                       seqs[room_id],
+                       start + i * 1000000,
+                       'message {}'.format(i))
+
+        cmd = "INSERT INTO message (room_id, user_id, seq, timestamp, message) VALUES(?, ?, ?, ?, ?)"
+        conn.executemany(cmd, rows())
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db_path')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=1000000)
+    args = parser.parse_args()
+    generate(args.db_path, args.users, args.rooms, args.messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Poll latency of the room history as it grows
+
+A poll asks for the last few seconds of a room, so its cost should stay
+flat no matter how many messages the room already holds.
+
+    python benchmarks/get_messages_bench.py
+"""
+import os
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from rumble_server.history import History
+from rumble_server.room import Room
+
+sizes = (1000, 10000, 100000, 1000000)
+polls = 10000
+block_size = 256
+
+
+def make_room(size):
+    # Everything stays resident, so the history never needs a database
+    history = History(None, None, block_size, max_messages=sys.maxint)
+    room = Room('bench', {}, threading.RLock(), 1)
+    room.last_seq = 0
+    room.last_timestamp = 0
+    for seq in xrange(1, size + 1):
+        # One message per second
+        timestamp = seq * 1000000
+        history.add_message(room, seq, timestamp, 1, 'message {}'.format(seq))
+        room.last_seq = seq
+        room.last_timestamp = timestamp
+    return history, room
+
+
+def main():
+    print('{:>10} {:>14}'.format('messages', 'usec per poll'))
+    for size in sizes:
+        history, room = make_room(size)
+        end = room.last_timestamp + 1000000
+        start = end - 10 * 1000000
+        elapsed = timeit.timeit(lambda: history.get_messages(room, start, end), number=polls)
+        print('{:>10} {:>14.2f}'.format(size, elapsed / polls * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""Load test of the REST API
+
+Builds the app with api.create_app on a generated database. Simulated
+clients log in, join a few rooms, then send and poll at random in the
+proportions of --mix. They go either through Flask's test client, or
+over real HTTP to a threaded werkzeug server.
+
+Reports throughput and p50/p99 latency per endpoint. Results are
+appended, with the current commit, to benchmarks/results/load_bench.jsonl
+and compared with the last run that used the same settings.
+
+    python benchmarks/load_bench.py --transport http --clients 16 --seconds 30
+"""
+import argparse
+import datetime
+import httplib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..'))
+from rumble_server import api, server
+from generate_db import generate
+
+results_file = os.path.join(script_dir, 'results', 'load_bench.jsonl')
+default_mix = 'send=2,poll=6,sync=1,login=0.1'
+
+
+class TestClientTransport(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, data=None, body=None):
+        kwargs = dict(headers=headers, data=data)
+        if body is not None:
+            kwargs.update(data=json.dumps(body), content_type='application/json')
+        response = self.client.open(path, method=method, **kwargs)
+        return response.status_code, response.data
+
+
+class HttpTransport(object):
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, headers, data=None, body=None):
+        headers = dict(headers)
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            data = urllib.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        try:
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+
+class Client(threading.Thread):
+    def __init__(self, transport, user, rooms, mix, deadline, seed):
+        """A user that logs in, joins rooms, and then sends and polls"""
+        super(Client, self).__init__()
+        self.daemon = True
+        self.transport = transport
+        self.user = user
+        self.rooms = rooms
+        self.mix = mix
+        self.deadline = deadline
+        self.rnd = random.Random(seed)
+        self.headers = {}
+        # room name -> last seq seen
+        self.cursors = {}
+        # endpoint -> [seconds, ...]
+        self.latencies = {}
+        self.errors = {}
+
+    def call(self, endpoint, method, path, data=None, body=None, ok=(200,)):
+        start = time.time()
+        status, response = self.transport.request(method, path, self.headers, data, body)
+        self.latencies.setdefault(endpoint, []).append(time.time() - start)
+        if status not in ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return None
+        return json.loads(response)
+
+    def login(self):
+        data = dict(username=self.user, password='password')
+        result = self.call('login', 'POST', '/active_user', data=data)
+        if result is not None:
+            self.headers = {'Authorization': result['user_auth']}
+
+    def run(self):
+        self.login()
+        for name in self.rooms:
+            # Memberships persist, so joining a room again is expected
+            self.call('join', 'POST', '/room_member/' + name, ok=(200, 400))
+            self.cursors[name] = 0
+        actions, weights = zip(*self.mix)
+        total = sum(weights)
+        while time.time() < self.deadline:
+            x = self.rnd.uniform(0, total)
+            for action, weight in zip(actions, weights):
+                x -= weight
+                if x <= 0:
+                    break
+            getattr(self, action)()
+
+    def send(self):
+        name = self.rnd.choice(self.rooms)
+        self.call('send', 'POST', '/message/' + name, data=dict(message='load test message'))
+
+    def poll(self):
+        name = self.rnd.choice(self.rooms)
+        path = '/messages_since/{}/{}?limit=100'.format(name, self.cursors[name])
+        result = self.call('poll', 'GET', path)
+        if result is not None:
+            self.cursors[name] = result['cursor']
+
+    def sync(self):
+        result = self.call('sync', 'POST', '/sync', body=dict(rooms=self.cursors))
+        if result is not None:
+            for name, room in result['rooms'].iteritems():
+                self.cursors[name] = room['cursor']
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=script_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        action, weight = item.split('=')
+        if action not in ('send', 'poll', 'sync', 'login'):
+            raise argparse.ArgumentTypeError('Unknown action: ' + action)
+        mix.append((action, float(weight)))
+    return mix
+
+
+def run(args):
+    if not args.reuse:
+        generate(args.db_path, args.users, args.rooms, args.messages)
+    if not args.rate_limits:
+        server.token_rate_limits = {}
+        server.ip_rate_limits = {}
+    server.instance = None
+    app = api.create_app(os.path.abspath(args.db_path))
+    server.get_instance()
+
+    http_server = None
+    if args.transport == 'http':
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        http_server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=http_server.serve_forever).start()
+
+    rnd = random.Random(args.seed)
+    deadline = time.time() + args.seconds
+    clients = []
+    for i in xrange(args.clients):
+        if http_server is None:
+            transport = TestClientTransport(app)
+        else:
+            transport = HttpTransport(http_server.server_port)
+        user = 'user{}'.format(rnd.randrange(args.users))
+        rooms = ['room{}'.format(r) for r in rnd.sample(xrange(args.rooms), args.rooms_per_client)]
+        clients.append(Client(transport, user, rooms, args.mix, deadline, rnd.random()))
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    if http_server is not None:
+        http_server.shutdown()
+    server.get_instance().disconnect()
+
+    endpoints = {}
+    for client in clients:
+        for endpoint, latencies in client.latencies.iteritems():
+            endpoints.setdefault(endpoint, dict(latencies=[], errors=0))['latencies'].extend(latencies)
+        for endpoint, errors in client.errors.iteritems():
+            endpoints[endpoint]['errors'] += errors
+    results = {}
+    for endpoint, e in endpoints.iteritems():
+        latencies = sorted(e['latencies'])
+        results[endpoint] = dict(requests=len(latencies),
+                                 errors=e['errors'],
+                                 throughput=len(latencies) / elapsed,
+                                 p50=percentile(latencies, 0.5),
+                                 p99=percentile(latencies, 0.99))
+    return results
+
+
+def load_previous(settings):
+    if not os.path.isfile(results_file):
+        return None
+    previous = None
+    with open(results_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['settings'] == settings:
+                previous = record
+    return previous
+
+
+def save(record):
+    if not os.path.isdir(os.path.dirname(results_file)):
+        os.makedirs(os.path.dirname(results_file))
+    with open(results_file, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def report(results, previous):
+    print('{:>8} {:>9} {:>7} {:>10} {:>10} {:>10}  {}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms',
+        'vs ' + previous['commit'] if previous else ''))
+    for endpoint in sorted(results):
+        r = results[endpoint]
+        change = ''
+        before = previous['results'].get(endpoint) if previous else None
+        if before:
+            change = 'p50 {:+.0%} p99 {:+.0%}'.format(r['p50'] / before['p50'] - 1,
+                                                      r['p99'] / before['p99'] - 1)
+        print('{:>8} {:>9} {:>7} {:>10.1f} {:>10.2f} {:>10.2f}  {}'.format(
+            endpoint, r['requests'], r['errors'], r['throughput'],
+            r['p50'] * 1000, r['p99'] * 1000, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-path', default='load_bench.db')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--reuse', action='store_true',
+                        help='use an existing database at --db-path')
+    parser.add_argument('--transport', choices=('client', 'http'), default='client')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--rooms-per-client', type=int, default=5)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(default_mix),
+                        help='relative weights of the actions, default ' + default_mix)
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the rate limits on, they are off by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    settings = dict(users=args.users, rooms=args.rooms, messages=args.messages,
+                    transport=args.transport, clients=args.clients,
+                    rooms_per_client=args.rooms_per_client, seconds=args.seconds,
+                    mix=args.mix, rate_limits=args.rate_limits, seed=args.seed)
+    # As it reads back from JSON
+    settings = json.loads(json.dumps(settings))
+    previous = load_previous(settings)
+    results = run(args)
+    report(results, previous)
+    if not args.no_save:
+        save(dict(commit=get_commit(),
+                  time=datetime.datetime.utcnow().isoformat(),
+                  settings=settings,
+                  results=results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Memory per message of the room history
+
+Compares the original {datetime: (handle, text)} dict with the
+array-backed history blocks, for the same messages. Both share the
+message texts, which are not counted.
+
+    python benchmarks/message_memory_bench.py
+"""
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from rumble_server.history import Block
+from rumble_server import timeutil
+
+count = 100000
+block_size = 256
+
+
+def dict_size(messages):
+    size = sys.getsizeof(messages)
+    for timestamp, message in messages.iteritems():
+        size += sys.getsizeof(timestamp) + sys.getsizeof(message)
+    return size
+
+
+def blocks_size(blocks):
+    size = sys.getsizeof(blocks)
+    for block in blocks.itervalues():
+        size += sys.getsizeof(block)
+        size += sum(sys.getsizeof(a) for a in (block.seqs, block.timestamps,
+                                               block.senders, block.texts))
+    return size
+
+
+def main():
+    start = datetime.datetime(2017, 1, 1)
+    texts = ['message {}'.format(i) for i in xrange(count)]
+
+    messages = {}
+    blocks = {}
+    for i, text in enumerate(texts):
+        timestamp = start + datetime.timedelta(microseconds=i)
+        messages[timestamp] = ('handle', text)
+        seq = i + 1
+        block = blocks.setdefault(seq // block_size, Block())
+        block.append(seq, timeutil.to_micros(timestamp), 1, text)
+
+    before = dict_size(messages) / float(count)
+    after = blocks_size(blocks) / float(count)
+    print('dict of tuples: {:.1f} bytes per message'.format(before))
+    print('blocks:         {:.1f} bytes per message'.format(after))
+    print('{:.1f}x smaller'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Server startup time against a generated database
+
+Measures constructing the Server (users and room metadata only) and the
+first poll of a room, which loads one page of history on demand. Then
+measures a restart, which loads the snapshot the first startup took.
+
+    python benchmarks/startup_bench.py --messages 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from rumble_server import server, timeutil
+from generate_db import generate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db-path', default='bench.db')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--reuse', action='store_true',
+                        help='use an existing database at --db-path')
+    args = parser.parse_args()
+
+    if not args.reuse:
+        t = time.time()
+        generate(args.db_path, args.users, args.rooms, args.messages)
+        print('generated {} messages in {:.2f}s'.format(args.messages, time.time() - t))
+
+    server.db_path = args.db_path
+    t = time.time()
+    s = server.Server()
+    print('startup: {:.3f}s'.format(time.time() - t))
+
+    room = s.rooms['room0']
+    end = timeutil.now()
+    start = end - 10 * 60 * 1000000
+    t = time.time()
+    messages = s.history.get_messages(room, start, end)
+    print('first poll: {:.3f}s ({} messages)'.format(time.time() - t, len(messages)))
+    t = time.time()
+    s.history.get_messages(room, start, end)
+    print('second poll: {:.6f}s'.format(time.time() - t))
+    s.disconnect()
+
+    t = time.time()
+    s = server.Server()
+    print('restart from snapshot: {:.3f}s'.format(time.time() - t))
+    s.disconnect()
+
+
+if __name__ == '__main__':
+    main()
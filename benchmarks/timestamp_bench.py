@@ -0,0 +1,45 @@
+"""Cost per timestamp of parsing and formatting
+
+Compares dateutil, which used to parse every timestamp the server read,
+with the strict fast path of timeutil.parse_iso, on the format the server
+emits, and shows the fallback cost for other formats.
+
+    python benchmarks/timestamp_bench.py
+"""
+import datetime
+import os
+import sys
+import timeit
+
+import dateutil.parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from rumble_server import timeutil
+
+count = 100000
+
+
+def dateutil_parse(text):
+    return timeutil.to_micros(dateutil.parser.parse(text).replace(tzinfo=None))
+
+
+def main():
+    timestamp = datetime.datetime(2017, 1, 1, 12, 34, 56, 123456)
+    micros = timeutil.to_micros(timestamp)
+    iso = timestamp.isoformat()
+    assert dateutil_parse(iso) == timeutil.parse_iso(iso) == micros
+
+    cases = (
+        ('dateutil.parser.parse', lambda: dateutil_parse(iso)),
+        ('parse_iso', lambda: timeutil.parse_iso(iso)),
+        ('parse_iso (fallback)', lambda: timeutil.parse_iso('Jan 1 2017 12:34:56')),
+        ('format_iso', lambda: timeutil.format_iso(micros)),
+    )
+    print('{:>24} {:>16}'.format('', 'usec per call'))
+    for name, f in cases:
+        elapsed = timeit.timeit(f, number=count)
+        print('{:>24} {:>16.2f}'.format(name, elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
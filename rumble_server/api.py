@@ -1,8 +1,14 @@
 import argparse
+import json
+import math
 import os
-from flask import Flask
+import time
+from flask import Flask, Response, g, request
 from flask_restful import Api
-from resources import User, Users, ActiveUser, RoomMember, RoomMembers, Room, Rooms, Message, Messages
+from cooperative import CooperativeServer
+import metrics
+from ratelimit import ConcurrencyLimit, RateLimiter
+from resources import User, Users, ActiveUser, RoomMember, RoomMembers, Room, Rooms, Message, MessageBatch, Messages, MessagesSince, NewMessages, Sync, Stream
 from flask_cors import CORS
 
 import server
@@ -13,15 +19,106 @@ def main():
 
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--db-path')
-    db_path = parser.parse_args().db_path
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--admin', action='append', default=[], metavar='USERNAME',
+                        help='a user allowed to import users, may be repeated')
+    parser.add_argument('--shard', type=parse_shard, metavar='INDEX/COUNT',
+                        help='serve as one of COUNT shards behind rumble_server/router.py, '
+                             'sharing the database with the others')
+    parser.add_argument('--gevent', action='store_true',
+                        help='serve with gevent, one greenlet per connection '
+                             '(requires the gevent package)')
+    parser.add_argument('--workers', type=int,
+                        help='serve with gunicorn, with this many pre-forked worker '
+                             'processes sharing the database (requires the gunicorn '
+                             'package). Send SIGHUP to reload them gracefully')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='request threads per worker process')
+    parser.add_argument('--backlog', type=int, default=2048,
+                        help='pending connections the listening socket holds')
+    parser.add_argument('--keep-alive', type=int, default=5,
+                        help='seconds an idle keep-alive connection stays open')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='seconds workers get to finish their requests on reload '
+                             'or shutdown')
+    args = parser.parse_args()
+    db_path = args.db_path
 
     print("If you run locally, browse to localhost:{}".format(port))
     host = '0.0.0.0'
-    port = int(os.environ.get("PORT", port))
+    port = args.port or int(os.environ.get("PORT", port))
+
+    server.user_admins = frozenset(args.admin)
+    if args.shard:
+        server.shard = args.shard
+        server.shared = True
+
+    if args.workers:
+        serve_prefork(db_path, host, port, args)
+        return
+
+    if args.gevent:
+        # Patch before the server creates its locks and events
+        from gevent import monkey
+        monkey.patch_all()
 
     # app.run(debug=opts.debug, port=opts.port, host=opts.host)
-    the_app = create_app(db_path)
-    the_app.run(host=host, port=port)
+    if args.gevent:
+        # Thousands of idle streams and long polls cost a greenlet each
+        from gevent.pywsgi import WSGIServer
+        WSGIServer((host, port), create_cooperative_app(db_path)).serve_forever()
+    else:
+        the_app = create_app(db_path)
+        # Threaded, so requests waiting for new messages don't block the others
+        the_app.run(host=host, port=port, threaded=True)
+
+def parse_shard(text):
+    try:
+        index, count = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected INDEX/COUNT, not ' + text)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('The index must be between 0 and COUNT - 1')
+    return index, count
+
+
+def serve_prefork(db_path, host, port, args):
+    """Serve with gunicorn's pre-forking master and threaded workers
+
+    Every worker builds its own app and Server after the fork, so none of
+    them share a database connection. The server runs in shared mode, where
+    the database is the common state, even with a single worker: on a
+    graceful reload the old workers finish their requests while the new
+    ones already serve.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    server.shared = True
+    options = dict(
+        bind='{}:{}'.format(host, port),
+        workers=args.workers,
+        threads=args.threads,
+        # gunicorn's gevent workers patch themselves
+        worker_class='gevent' if args.gevent else 'gthread' if args.threads > 1 else 'sync',
+        backlog=args.backlog,
+        keepalive=args.keep_alive,
+        graceful_timeout=args.graceful_timeout,
+        # Long polls legitimately keep a request busy for a while
+        timeout=server.max_wait_seconds + 30,
+    )
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.iteritems():
+                self.cfg.set(key, value)
+
+        def load(self):
+            if args.gevent:
+                return create_cooperative_app(db_path)
+            return create_app(db_path)
+
+    Application().run()
+
 
 def create_app(db_path):
     if db_path is not None:
@@ -39,14 +136,101 @@ def create_app(db_path):
         (Room, '/room/<name>'),
         (Rooms, '/rooms'),
         (Message, '/message/<name>'),
-        (Messages, '/messages/<name>/<start>/<end>')
+        (MessageBatch, '/message_batch'),
+        (Messages, '/messages/<name>/<start>/<end>'),
+        (MessagesSince, '/messages_since/<name>/<int:seq>'),
+        (NewMessages, '/new_messages/<name>/<since>'),
+        (Sync, '/sync'),
+        (Stream, '/stream')
     )
 
     for resource, route in resource_map:
         api.add_resource(resource, route)
 
+    add_metrics(app)
+    add_admission_control(app)
     return app
 
 
+def create_cooperative_app(db_path):
+    """The app, served by a CooperativeServer
+
+    For gevent, once its monkey patching is applied.
+    """
+    app = create_app(db_path)
+    server.instance = CooperativeServer()
+    return app
+
+
+def add_metrics(app):
+    """Time every request, and serve all metrics at /metrics
+
+    Added before admission control, so rejected requests are counted too.
+    """
+    request_metrics = metrics.RequestMetrics()
+
+    @app.before_request
+    def start_timer():
+        g.start_time = time.time()
+
+    @app.after_request
+    def record(response):
+        start_time = g.pop('start_time', None)
+        if start_time is not None:
+            request_metrics.record(request.endpoint or 'unknown',
+                                   response.status_code,
+                                   time.time() - start_time)
+        return response
+
+    def show_metrics():
+        text = metrics.render(request_metrics, server.get_instance())
+        return Response(text, mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', show_metrics)
+
+
+def add_admission_control(app):
+    """Rate limit requests per auth token and per IP, and cap concurrency
+
+    Requests over a rate limit get a 429 and requests beyond the
+    concurrency cap a 503, both with a Retry-After header. Long running
+    resources, which mostly wait, don't count against the cap.
+
+    Behind the router, the client's IP is taken from X-Forwarded-For.
+    """
+    token_limiter = RateLimiter(server.token_rate_limits)
+    ip_limiter = RateLimiter(server.ip_rate_limits)
+    concurrency = ConcurrencyLimit(server.max_concurrent_requests)
+
+    def reject(status_code, message, retry_after):
+        headers = {'Retry-After': str(int(math.ceil(retry_after)))}
+        return Response(json.dumps(dict(message=message)), status_code, headers,
+                        mimetype='application/json')
+
+    @app.before_request
+    def admit():
+        resource = getattr(app.view_functions.get(request.endpoint), 'view_class', None)
+        if resource is None:
+            return None
+        name = resource.__name__
+        remote_addr = request.access_route[0] if server.shard else request.remote_addr
+        wait = ip_limiter.acquire(name, remote_addr)
+        user_auth = request.headers.get('Authorization')
+        if not wait and user_auth is not None:
+            wait = token_limiter.acquire(name, user_auth)
+        if wait:
+            return reject(429, 'Too many requests', wait)
+        if not getattr(resource, 'long_running', False):
+            if not concurrency.enter():
+                return reject(503, 'Server busy', 1)
+            g.admitted = True
+        return None
+
+    @app.teardown_request
+    def leave(exc):
+        if g.pop('admitted', False):
+            concurrency.leave()
+
+
 if __name__ == "__main__":
     main()
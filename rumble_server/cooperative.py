@@ -0,0 +1,31 @@
+"""A Server for gevent, where SQLite calls don't hold up the other requests
+
+Once gevent's monkey patching is applied, request threads are greenlets,
+and the server lock, the message waiters and the stream subscriptions are
+gevent primitives. An idle long poll or stream then only costs a
+greenlet. SQLite calls don't yield to other greenlets though, so here
+they run on gevent's pool of real threads while the calling greenlet
+waits.
+"""
+from db import Database
+from server import Server
+
+
+def run_in_threadpool(function, *args):
+    """Run function on a thread of gevent's pool, and wait for its result"""
+    from gevent import get_hub
+    return get_hub().threadpool.apply(function, args)
+
+
+class ThreadpoolDatabase(Database):
+    # run(function, *args) runs function on another thread and returns its
+    # result, or raises its exception
+    run = staticmethod(run_in_threadpool)
+
+    def _call(self, function, *args):
+        # A transaction holds its connection, so no two threads use it at once
+        return self.run(function, *args)
+
+
+class CooperativeServer(Server):
+    database_class = ThreadpoolDatabase
@@ -0,0 +1,224 @@
+import contextlib
+import Queue
+import sqlite3
+import threading
+import time
+
+# Applied to every new connection. WAL lets readers run alongside the writer,
+# and synchronous=NORMAL only syncs the WAL at checkpoints.
+pragmas = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# Every statement the server runs, by name. They are all parameterized, so
+# sqlite3's statement cache compiles each one once per connection.
+statements = dict(
+    create_message_index="CREATE INDEX IF NOT EXISTS message_room_timestamp "
+                         "ON message(room_id, timestamp)",
+    create_message_seq_index="CREATE UNIQUE INDEX IF NOT EXISTS message_room_seq "
+                             "ON message(room_id, seq)",
+    select_message_columns="PRAGMA table_info(message)",
+    add_message_seq="ALTER TABLE message ADD COLUMN seq INTEGER",
+    select_message_ids="SELECT id, room_id FROM message ORDER BY room_id, id",
+    set_message_seq="UPDATE message SET seq = ? WHERE id = ?",
+    create_message_table="CREATE TABLE message_new(id INTEGER PRIMARY KEY, "
+                         "room_id references room(id), user_id references user(id), "
+                         "timestamp INTEGER, message TEXT, seq INTEGER)",
+    select_messages="SELECT id, room_id, user_id, timestamp, message, seq FROM message",
+    insert_migrated_message="INSERT INTO message_new "
+                            "(id, room_id, user_id, timestamp, message, seq) "
+                            "VALUES(?, ?, ?, ?, ?, ?)",
+    drop_migrated_message_table="DROP TABLE IF EXISTS message_new",
+    drop_message_table="DROP TABLE message",
+    rename_message_table="ALTER TABLE message_new RENAME TO message",
+    create_room_name_index="CREATE UNIQUE INDEX IF NOT EXISTS room_name ON room(name)",
+    create_user_name_index="CREATE UNIQUE INDEX IF NOT EXISTS user_name ON user(name)",
+    create_user_handle_index="CREATE UNIQUE INDEX IF NOT EXISTS user_handle ON user(handle)",
+    create_membership_table="CREATE TABLE IF NOT EXISTS membership(id INTEGER PRIMARY KEY, "
+                            "user_id references user(id), room_id references room(id))",
+    create_membership_index="CREATE UNIQUE INDEX IF NOT EXISTS membership_user_room "
+                            "ON membership(user_id, room_id)",
+    create_session_table="CREATE TABLE IF NOT EXISTS session(token TEXT PRIMARY KEY, "
+                         "user_id references user(id))",
+    create_change_table="CREATE TABLE IF NOT EXISTS change(id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "origin TEXT, timestamp INTEGER, kind TEXT, data TEXT)",
+    select_last_change="SELECT COALESCE(MAX(id), 0) FROM change",
+    select_changes="SELECT id, origin, kind, data FROM change WHERE id > ? ORDER BY id LIMIT 1000",
+    insert_change="INSERT INTO change (origin, timestamp, kind, data) VALUES(?, ?, ?, ?)",
+    delete_changes_before="DELETE FROM change WHERE timestamp < ?",
+    select_users="SELECT id, name, password, handle FROM user",
+    select_user_by_name="SELECT id, name, password, handle FROM user WHERE name = ?",
+    select_user_by_id="SELECT id, name, password, handle FROM user WHERE id = ?",
+    select_session="SELECT user_id FROM session WHERE token = ?",
+    select_session_handles="SELECT DISTINCT user.handle FROM session "
+                           "JOIN user ON user.id = session.user_id",
+    insert_session="INSERT INTO session (token, user_id) VALUES(?, ?)",
+    delete_session="DELETE FROM session WHERE token = ?",
+    delete_user_sessions="DELETE FROM session WHERE user_id = ?",
+    insert_user="INSERT INTO user (name, password, handle) VALUES(?, ?, ?)",
+    select_rooms="SELECT id, name FROM room",
+    insert_room="INSERT INTO room (name) VALUES(?)",
+    delete_room="DELETE FROM room WHERE id = ?",
+    insert_message="INSERT INTO message (room_id, user_id, seq, timestamp, message) "
+                   "VALUES(?, ?, ?, ?, ?)",
+    # Takes the next seq and timestamp of the room from the database, for
+    # processes sharing it. Parameters: room id, user id, now, message, room id
+    insert_next_message="INSERT INTO message (room_id, user_id, seq, timestamp, message) "
+                        "SELECT ?, ?, COALESCE(MAX(seq), 0) + 1, "
+                        "MAX(?, COALESCE(MAX(timestamp), 0) + 1), ? "
+                        "FROM message WHERE room_id = ?",
+    select_message_seq="SELECT seq, timestamp FROM message WHERE id = ?",
+    select_last_message="SELECT seq, timestamp FROM message WHERE room_id = ? "
+                        "ORDER BY seq DESC LIMIT 1",
+    select_history="SELECT seq, timestamp, user_id, message FROM message "
+                   "WHERE room_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+    select_seq_at="SELECT seq FROM message WHERE room_id = ? AND timestamp >= ? "
+                  "ORDER BY timestamp LIMIT 1",
+    delete_room_messages="DELETE FROM message WHERE room_id = ?",
+    select_memberships="SELECT user_id, room_id FROM membership",
+    insert_membership="INSERT INTO membership (user_id, room_id) VALUES(?, ?)",
+    delete_membership="DELETE FROM membership WHERE user_id = ? AND room_id = ?",
+    delete_room_memberships="DELETE FROM membership WHERE room_id = ?",
+    create_snapshot_table="CREATE TABLE IF NOT EXISTS snapshot(token TEXT)",
+    create_process_table="CREATE TABLE IF NOT EXISTS process(id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "origin TEXT, started INTEGER)",
+    insert_process="INSERT INTO process (origin, started) VALUES(?, ?)",
+    select_snapshot_token="SELECT token FROM snapshot",
+    delete_snapshot_token="DELETE FROM snapshot",
+    insert_snapshot_token="INSERT INTO snapshot (token) VALUES(?)",
+    begin_transaction="BEGIN IMMEDIATE",
+    select_max_ids="SELECT (SELECT COALESCE(MAX(id), 0) FROM user), "
+                   "(SELECT COALESCE(MAX(id), 0) FROM room)",
+)
+
+
+class StatementStats(object):
+    def __init__(self):
+        """Call counts and cumulative seconds per statement name
+
+        Shared by every Database of a server, whatever thread uses them.
+        """
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.seconds = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def snapshot(self):
+        """:return: {name: (calls, seconds)}"""
+        with self.lock:
+            return {name: (self.calls[name], self.seconds[name]) for name in self.calls}
+
+
+def _fetch_all(conn, statement, params):
+    return conn.execute(statement, params).fetchall()
+
+
+class Database(object):
+    def __init__(self, path, stats, pool_size=1):
+        """A bounded pool of connections that run the named statements
+
+        Statements run inside a transaction, which is opened by using the
+        database as a context manager. The transaction holds one connection
+        of the pool for the calling thread, so up to pool_size threads can
+        use the database at once and the others wait for a connection.
+        """
+        self.stats = stats
+        self.connections = [self._connect(path) for _ in xrange(pool_size)]
+        self.pool = Queue.Queue()
+        for conn in self.connections:
+            self.pool.put(conn)
+        self.local = threading.local()
+
+    @staticmethod
+    def _connect(path):
+        conn = sqlite3.connect(path, check_same_thread=False)
+        for pragma in pragmas:
+            conn.execute(pragma)
+        return conn
+
+    @property
+    def conn(self):
+        """The connection of the calling thread's transaction"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            raise RuntimeError('Statements must run in a transaction ("with database:")')
+        return conn
+
+    def __enter__(self):
+        if getattr(self.local, 'conn', None) is not None:
+            self.local.depth += 1
+            return self.local.conn
+        conn = self.pool.get()
+        self.local.conn = conn
+        self.local.depth = 1
+        return conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        self.local.depth -= 1
+        if self.local.depth:
+            return False
+        conn = self.local.conn
+        self.local.conn = None
+        try:
+            # Commits or rolls back
+            return self._call(conn.__exit__, *exc_info)
+        finally:
+            self.pool.put(conn)
+
+    @contextlib.contextmanager
+    def schema_transaction(self):
+        """A transaction that may also change the schema
+
+        Python 2's sqlite3 commits before every CREATE, DROP and ALTER
+        statement, so here the transaction is begun explicitly instead.
+        """
+        with self as conn:
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None
+            try:
+                self.execute('begin_transaction')
+                yield conn
+            finally:
+                conn.isolation_level = isolation_level
+
+    def _call(self, function, *args):
+        """Every call into SQLite goes through here, see cooperative.ThreadpoolDatabase"""
+        return function(*args)
+
+    def execute(self, name, params=()):
+        """Run a statement
+
+        :return: the cursor, e.g. for its lastrowid
+        """
+        start = time.time()
+        try:
+            return self._call(self.conn.execute, statements[name], params)
+        finally:
+            self.stats.record(name, time.time() - start)
+
+    def executemany(self, name, rows):
+        start = time.time()
+        try:
+            return self._call(self.conn.executemany, statements[name], rows)
+        finally:
+            self.stats.record(name, time.time() - start)
+
+    def query(self, name, params=()):
+        """Run a statement and fetch all its rows"""
+        start = time.time()
+        try:
+            return self._call(_fetch_all, self.conn, statements[name], params)
+        finally:
+            self.stats.record(name, time.time() - start)
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
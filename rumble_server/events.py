@@ -0,0 +1,30 @@
+import collections
+
+
+class EventLog(object):
+    def __init__(self, max_events, start=0):
+        """The latest changes to rooms and memberships, for clients to sync
+
+        Every event gets the next version number, the first start + 1.
+        Only the last max_events are kept, a client further behind than
+        that has to start over.
+        """
+        self.version = start
+        # (version, kind, room name, handle)
+        self.events = collections.deque(maxlen=max_events)
+
+    def append(self, kind, room, handle=None):
+        self.version += 1
+        self.events.append((self.version, kind, room, handle))
+        return self.version
+
+    def since(self, version):
+        """:return: the events after version, or None if some were dropped
+        """
+        if version > self.version:
+            # From before a restart
+            return None
+        first = self.events[0][0] if self.events else self.version + 1
+        if version < first - 1:
+            return None
+        return list(self.events)[version - first + 1:]
@@ -0,0 +1,75 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from db import Database
+import timeutil
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeFeed(threading.Thread):
+    def __init__(self, db_path, db_stats, cursor, origin, apply, interval, retention,
+                 database_class=Database):
+        """Follows the changes other processes make to the shared database
+
+        Every process sharing the database records its changes in the
+        change table, in the same transaction as the changes themselves.
+        This thread, with its own connection, polls the table every
+        interval seconds for changes after cursor, and passes those of
+        other origins to apply([(kind, data), ...]).
+
+        Changes older than retention seconds are deleted.
+        """
+        super(ChangeFeed, self).__init__(name='ChangeFeed')
+        self.daemon = True
+        self.db_path = db_path
+        self.db_stats = db_stats
+        self.database_class = database_class
+        self.cursor = cursor
+        self.origin = origin
+        self.apply = apply
+        self.interval = interval
+        self.retention = retention
+        self.stopped = threading.Event()
+
+    def close(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        db = self.database_class(self.db_path, self.db_stats)
+        pruned = 0
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.poll(db)
+                    if time.time() - pruned > self.retention / 10.0:
+                        pruned = time.time()
+                        with db:
+                            db.execute('delete_changes_before',
+                                       (timeutil.now() - self.retention * 1000000,))
+                except sqlite3.OperationalError:
+                    # Most likely the database is locked, try again
+                    logger.exception('Failed to read changes, retrying')
+                self.stopped.wait(self.interval)
+        finally:
+            db.close()
+
+    def poll(self, db):
+        with db:
+            rows = db.query('select_changes', (self.cursor,))
+        if not rows:
+            return
+        self.cursor = rows[-1][0]
+        changes = [(kind, json.loads(data)) for _, origin, kind, data in rows
+                   if origin != self.origin]
+        if changes:
+            self.apply(changes)
+
+
+def record(db, origin, kind, *data):
+    """Record a change in the current transaction of db"""
+    db.execute('insert_change', (origin, timeutil.now(), kind, json.dumps(data)))
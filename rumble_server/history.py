@@ -0,0 +1,261 @@
+import bisect
+import sys
+from array import array
+from collections import OrderedDict
+
+# A list slot per text or encoded message
+message_overhead = 8
+
+
+class Block(object):
+    __slots__ = ('seqs', 'timestamps', 'senders', 'texts', 'encoded', 'nbytes')
+
+    def __init__(self):
+        # A fixed range of sequence ids of a room's history, as parallel
+        # arrays sorted by sequence id, and therefore by timestamp too
+        self.seqs = array('l')
+        # Microseconds since the epoch, as doubles, which hold them exactly
+        # up to 2 ** 53. A C long is only 32 bits on Windows
+        self.timestamps = array('d')
+        # User ids of the senders
+        self.senders = array('l')
+        self.texts = []
+        # The JSON of the first len(encoded) messages, so messages appended
+        # since are simply not encoded yet
+        self.encoded = []
+        # Approximate memory held by the block, its messages and their JSON
+        self.nbytes = sys.getsizeof(self)
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def append(self, seq, timestamp, sender, text):
+        self.seqs.append(seq)
+        self.timestamps.append(timestamp)
+        self.senders.append(sender)
+        self.texts.append(text)
+        self.nbytes += (2 * self.seqs.itemsize + self.timestamps.itemsize +
+                        message_overhead + sys.getsizeof(text))
+
+    def get_range(self, first, end):
+        """Return [(seq, timestamp, sender, text), ...] for first <= seq < end
+        """
+        lo = bisect.bisect_left(self.seqs, first)
+        hi = bisect.bisect_left(self.seqs, end, lo)
+        return zip(self.seqs[lo:hi], map(int, self.timestamps[lo:hi]),
+                   self.senders[lo:hi], self.texts[lo:hi])
+
+    def get_encoded(self, first, end, encode):
+        """Return ([json, ...] for first <= seq < end, whether all were cached)
+        """
+        lo = bisect.bisect_left(self.seqs, first)
+        hi = bisect.bisect_left(self.seqs, end, lo)
+        cached = hi <= len(self.encoded)
+        for i in xrange(len(self.encoded), hi):
+            encoded = encode(self.seqs[i], int(self.timestamps[i]), self.senders[i], self.texts[i])
+            self.encoded.append(encoded)
+            self.nbytes += message_overhead + sys.getsizeof(encoded)
+        return self.encoded[lo:hi], cached
+
+
+class History(object):
+    def __init__(self, db, writer, block_size, max_messages):
+        """Room history, loaded on demand one block of sequence ids at a time
+
+        Every message of a room has a sequence id, starting at 1 and
+        increasing with every message, and block n holds the messages with
+        n * block_size <= seq < (n + 1) * block_size. Resident blocks live
+        in room.blocks and are evicted least recently used first once more
+        than max_messages messages are held in memory.
+
+        Blocks are loaded from db, after flushing writer so every message
+        accepted so far is stored.
+        """
+        self.db = db
+        self.writer = writer
+        self.block_size = block_size
+        self.max_messages = max_messages
+        # (room name, block index) -> room, in least recently used order
+        self.lru = OrderedDict()
+        # Messages held in resident blocks, counting each block as one more
+        # so empty blocks are eventually evicted too
+        self.size = 0
+        # Blocks whose JSON was, or was not, all cached by get_encoded
+        self.encoded_hits = 0
+        self.encoded_misses = 0
+
+    def block_index(self, seq):
+        return seq // self.block_size
+
+    def load_tail(self, room):
+        """Make sure room.last_seq and room.last_timestamp are known"""
+        if room.last_seq is not None:
+            return
+        # Nothing can be waiting in the writer, messages are only accepted
+        # once the tail is known
+        with self.db:
+            rows = self.db.query('select_last_message', (room.id,))
+        if rows:
+            room.last_seq = rows[0][0]
+            room.last_timestamp = rows[0][1]
+        else:
+            room.last_seq = 0
+            room.last_timestamp = 0
+
+    def add_message(self, room, seq, timestamp, sender, text):
+        """Record a new message in its block
+
+        A message that starts a block is all of that block so far, so the
+        block is created. Otherwise, if the block is not resident, it will
+        include the message when it is loaded.
+        """
+        index = self.block_index(seq)
+        block = room.blocks.get(index)
+        if block is None:
+            if seq != max(index * self.block_size, 1):
+                return
+            block = Block()
+            self._add_block(room, index, block)
+        block.append(seq, timestamp, sender, text)
+        self.size += 1
+        self._evict()
+
+    def forget_after(self, room, seq):
+        """Drop the resident blocks that should hold messages after seq
+
+        For messages added by another process, which those blocks lack.
+        They are loaded again, with the messages, when they are needed.
+        """
+        first = self.block_index(seq + 1)
+        for index in [i for i in room.blocks if i >= first]:
+            self._drop_block(room, index)
+
+    def get_range(self, room, first, end):
+        """Return [(seq, timestamp, sender, text), ...] for first <= seq < end
+        """
+        result = []
+        for block in self._get_blocks(room, first, end):
+            result.extend(block.get_range(first, end))
+        self._evict()
+        return result
+
+    def get_encoded(self, room, first, end, encode):
+        """Return [json, ...] for the messages with first <= seq < end
+
+        Blocks cache the JSON of their messages, encoded the first time a
+        response includes them by encode(seq, timestamp, sender, text), so
+        a window many clients ask for is encoded only once. Appending to a
+        block leaves the new message to be encoded, and dropped or evicted
+        blocks take their JSON with them.
+        """
+        result = []
+        for block in self._get_blocks(room, first, end):
+            encoded, cached = block.get_encoded(first, end, encode)
+            if cached:
+                self.encoded_hits += 1
+            else:
+                self.encoded_misses += 1
+            result.extend(encoded)
+        self._evict()
+        return result
+
+    def get_messages(self, room, start, end):
+        """Return [(seq, timestamp, sender, text), ...] for start <= timestamp < end
+        """
+        return self.get_range(room,
+                              self.find_seq(room, start),
+                              self.find_seq(room, end))
+
+    def find_seq(self, room, timestamp):
+        """Return the seq of the first message at or after timestamp
+
+        Recent timestamps are found in the resident blocks at the end of the
+        history, older ones with an indexed query.
+
+        :return: the seq, or room.last_seq + 1 if there is no such message
+        """
+        self.load_tail(room)
+        next_seq = room.last_seq + 1
+        index = self.block_index(room.last_seq)
+        while index in room.blocks:
+            block = room.blocks[index]
+            if block and block.timestamps[0] <= timestamp:
+                i = bisect.bisect_left(block.timestamps, timestamp)
+                return block.seqs[i] if i < len(block) else next_seq
+            if block:
+                next_seq = block.seqs[0]
+            if index == 0:
+                return next_seq
+            index -= 1
+
+        self.writer.flush()
+        with self.db:
+            rows = self.db.query('select_seq_at', (room.id, timestamp))
+        return rows[0][0] if rows else room.last_seq + 1
+
+    def sizes(self):
+        """:return: {room name: (resident messages, approximate bytes)}"""
+        result = {}
+        for (name, index), room in self.lru.iteritems():
+            block = room.blocks[index]
+            messages, nbytes = result.get(name, (0, 0))
+            result[name] = messages + len(block), nbytes + block.nbytes
+        return result
+
+    def drop_room(self, room):
+        for index in room.blocks.keys():
+            self._drop_block(room, index)
+
+    def _drop_block(self, room, index):
+        del self.lru[(room.name, index)]
+        self.size -= len(room.blocks.pop(index)) + 1
+
+    def _get_blocks(self, room, first, end):
+        """Return the blocks holding first <= seq < end, loading missing ones
+
+        The blocks are marked as most recently used, the caller evicts once
+        it is done with them.
+        """
+        self.load_tail(room)
+        first = max(first, 1)
+        end = min(end, room.last_seq + 1)
+        if first >= end:
+            return []
+        indexes = range(self.block_index(first), self.block_index(end - 1) + 1)
+        missing = [i for i in indexes if i not in room.blocks]
+        if missing:
+            self._load(room, missing[0], missing[-1])
+
+        for index in indexes:
+            key = (room.name, index)
+            self.lru[key] = self.lru.pop(key)
+        return [room.blocks[index] for index in indexes]
+
+    def _load(self, room, first, last):
+        """Load blocks first..last with a single query
+
+        Blocks in that range which are already resident are kept as is.
+        """
+        self.writer.flush()
+        with self.db:
+            rows = self.db.query('select_history', (room.id,
+                                                    first * self.block_size,
+                                                    (last + 1) * self.block_size))
+        blocks = {}
+        for seq, timestamp, sender, text in rows:
+            block = blocks.setdefault(self.block_index(seq), Block())
+            block.append(seq, timestamp, sender, text)
+        for index in xrange(first, last + 1):
+            if index not in room.blocks:
+                self._add_block(room, index, blocks.get(index, Block()))
+
+    def _add_block(self, room, index, block):
+        room.blocks[index] = block
+        self.lru[(room.name, index)] = room
+        self.size += len(block) + 1
+
+    def _evict(self):
+        while self.size > self.max_messages and self.lru:
+            (name, index), room = self.lru.popitem(last=False)
+            block = room.blocks.pop(index)
+            self.size -= len(block) + 1
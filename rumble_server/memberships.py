@@ -0,0 +1,29 @@
+class Memberships(object):
+    def __init__(self):
+        """Who is in which room, by user rather than by session
+
+        Each room's members, user id -> User, is the forward index, and
+        by_user the reverse one, so both the members of a room and the
+        rooms of a user are found without scanning.
+        """
+        # user id -> names of the user's rooms
+        self.by_user = {}
+
+    def add(self, room, user):
+        room.add_member(user)
+        self.by_user.setdefault(user.id, set()).add(room.name)
+
+    def remove(self, room, user):
+        room.remove_member(user)
+        names = self.by_user[user.id]
+        names.discard(room.name)
+        if not names:
+            del self.by_user[user.id]
+
+    def rooms(self, user):
+        """:return: the names of the rooms the user is in"""
+        return self.by_user.get(user.id, set())
+
+    def drop_room(self, room):
+        for user in room.members.values():
+            self.remove(room, user)
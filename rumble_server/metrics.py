@@ -0,0 +1,111 @@
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # One count per bucket, the last one for values above every bound
+        self.counts = [0] * (len(latency_buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(latency_buckets, value)] += 1
+        self.sum += value
+
+
+class RequestMetrics(object):
+    def __init__(self):
+        """Latency and response counts per route
+
+        Recording a request is a dict lookup and a few additions under a
+        lock, cheap enough to leave on under load.
+        """
+        self.lock = threading.Lock()
+        # route -> Histogram
+        self.latency = {}
+        # (route, status code) -> count
+        self.responses = {}
+
+    def record(self, route, status, seconds):
+        with self.lock:
+            histogram = self.latency.get(route)
+            if histogram is None:
+                histogram = self.latency[route] = Histogram()
+            histogram.observe(seconds)
+            key = (route, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def snapshot(self):
+        """:return: ({route: (bucket counts, sum)}, {(route, status): count})"""
+        with self.lock:
+            latency = {route: (list(h.counts), h.sum) for route, h in self.latency.iteritems()}
+            return latency, dict(self.responses)
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.iteritems())) + '}'
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(request_metrics, server):
+    """All metrics, in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            value = repr(value) if isinstance(value, float) else str(value)
+            lines.append('{}{}{} {}'.format(name, suffix, labels, value))
+
+    latency, responses = request_metrics.snapshot()
+    samples = []
+    for route, (counts, total) in sorted(latency.iteritems()):
+        cumulative = 0
+        for bound, count in zip(latency_buckets + ('+Inf',), counts):
+            cumulative += count
+            samples.append(('_bucket', _labels(route=route, le=bound), cumulative))
+        samples.append(('_sum', _labels(route=route), total))
+        samples.append(('_count', _labels(route=route), cumulative))
+    metric('rumble_request_duration_seconds', 'histogram', 'Request latency by route', samples)
+    metric('rumble_requests_total', 'counter', 'Responses by route and status code',
+           [('', _labels(route=route, status=status), count)
+            for (route, status), count in sorted(responses.iteritems())])
+
+    db_stats = sorted(server.get_db_stats().iteritems())
+    metric('rumble_sqlite_calls_total', 'counter', 'SQLite statements run',
+           [('', _labels(statement=name), calls) for name, (calls, _) in db_stats])
+    metric('rumble_sqlite_seconds_total', 'counter', 'Time spent running SQLite statements',
+           [('', _labels(statement=name), seconds) for name, (_, seconds) in db_stats])
+
+    method_stats = sorted(server.get_method_stats().iteritems())
+    metric('rumble_server_calls_total', 'counter', 'Server method calls',
+           [('', _labels(method=name), calls) for name, (calls, _) in method_stats])
+    metric('rumble_server_seconds_total', 'counter',
+           'Time spent in Server methods, including waiting for the server lock',
+           [('', _labels(method=name), seconds) for name, (_, seconds) in method_stats])
+
+    memory = server.get_memory_stats()
+    metric('rumble_rooms', 'gauge', 'Rooms', [('', '', memory['rooms'])])
+    metric('rumble_sessions', 'gauge', 'Logged in sessions', [('', '', memory['sessions'])])
+    metric('rumble_room_resident_messages', 'gauge', 'Messages of a room held in memory',
+           [('', _labels(room=name), count) for name, count in sorted(memory['messages'].iteritems())])
+    metric('rumble_history_bytes', 'gauge', 'Approximate memory held by the resident history',
+           [('', '', memory['history_bytes'])])
+
+    cache = server.get_cache_stats()
+    metric('rumble_json_cache_hits_total', 'counter', 'History blocks served from cached JSON',
+           [('', '', cache['hits'])])
+    metric('rumble_json_cache_misses_total', 'counter', 'History blocks that needed encoding',
+           [('', '', cache['misses'])])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,122 @@
+import collections
+import threading
+
+
+class Subscription(object):
+    def __init__(self, rooms, max_pending, user_id=None, user_auth=None):
+        """A subscriber's queue of events from one or more rooms
+
+        Publishing never blocks. A subscriber that falls more than
+        max_pending events behind is marked as overflowed and dropped,
+        and has to catch up through the REST resources. A subscription is
+        closed, with the reason in closed, once its session or its user's
+        membership of one of the rooms ends.
+        """
+        self.rooms = rooms
+        self.max_pending = max_pending
+        self.user_id = user_id
+        self.user_auth = user_auth
+        self.pending = collections.deque()
+        self.overflowed = False
+        self.closed = None
+        self.ready = threading.Event()
+
+    def put(self, event):
+        if self.closed is not None:
+            return False
+        if len(self.pending) >= self.max_pending:
+            self.overflowed = True
+        else:
+            self.pending.append(event)
+        self.ready.set()
+        return not self.overflowed
+
+    def get(self, timeout):
+        """Wait up to timeout seconds for events and return all pending ones
+        """
+        self.ready.wait(timeout)
+        self.ready.clear()
+        events = []
+        while self.pending:
+            events.append(self.pending.popleft())
+        return events
+
+    def close(self, reason):
+        """Stop receiving events, the pending ones can still be got"""
+        self.closed = reason
+        self.ready.set()
+
+
+class Broker(object):
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        # room name -> set of subscriptions
+        self.subscribers = {}
+        # user id -> set of subscriptions
+        self.by_user = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, rooms, user_id=None, user_auth=None):
+        subscription = Subscription(rooms, self.max_pending, user_id, user_auth)
+        with self.lock:
+            for name in rooms:
+                self.subscribers.setdefault(name, set()).add(subscription)
+            if user_id is not None:
+                self.by_user.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self._unsubscribe(subscription)
+
+    def _unsubscribe(self, subscription):
+        for name in subscription.rooms:
+            subscribers = self.subscribers.get(name)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscribers[name]
+        subscriptions = self.by_user.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.by_user[subscription.user_id]
+
+    def _close(self, subscriptions, reason):
+        with self.lock:
+            for subscription in subscriptions:
+                self._unsubscribe(subscription)
+        for subscription in subscriptions:
+            subscription.close(reason)
+
+    def close_member(self, user_id, name):
+        """Close a user's subscriptions to a room the user left"""
+        with self.lock:
+            subscriptions = [s for s in self.by_user.get(user_id, ()) if name in s.rooms]
+        self._close(subscriptions, 'member_left')
+
+    def close_session(self, user_id, user_auth):
+        """Close the subscriptions of a session that ended"""
+        with self.lock:
+            subscriptions = [s for s in self.by_user.get(user_id, ()) if s.user_auth == user_auth]
+        self._close(subscriptions, 'session_ended')
+
+    def has_subscribers(self, name):
+        with self.lock:
+            return name in self.subscribers
+
+    def publish(self, name, event):
+        """Fan out an event to the subscribers of a room, dropping slow ones
+        """
+        with self.lock:
+            subscribers = list(self.subscribers.get(name, ()))
+        for subscription in subscribers:
+            if not subscription.put(event):
+                self.unsubscribe(subscription)
+
+    def drop_room(self, name):
+        """Close the subscriptions to a destroyed room"""
+        with self.lock:
+            subscriptions = list(self.subscribers.get(name, ()))
+        self._close(subscriptions, 'room_destroyed')
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+
+
+class RateLimiter(object):
+    def __init__(self, limits, max_buckets=100000):
+        """Token buckets per resource class and client key
+
+        limits maps a resource class name to (requests per second, burst).
+        Buckets are refilled lazily when they are used, so each check is
+        O(1). Once there are max_buckets, the least recently used one is
+        dropped to make room for a new one.
+        """
+        self.limits = limits
+        self.max_buckets = max_buckets
+        # (resource class name, key) -> TokenBucket, least recently used first
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, resource, key):
+        """Take a token from the bucket of a client for a resource class
+
+        :return: 0 if the request may go ahead, or else the seconds until
+                 the bucket has a token again
+        """
+        limit = self.limits.get(resource)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.pop((resource, key), None)
+            if bucket is None:
+                if len(self.buckets) >= self.max_buckets:
+                    self.buckets.popitem(last=False)
+                bucket = TokenBucket(burst, now)
+            else:
+                bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+                bucket.updated = now
+            # Moved to the end, as the most recently used
+            self.buckets[(resource, key)] = bucket
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            return (1 - bucket.tokens) / rate
+
+
+class ConcurrencyLimit(object):
+    def __init__(self, max_requests):
+        """Admits at most max_requests at once, without ever waiting"""
+        self.semaphore = threading.BoundedSemaphore(max_requests)
+
+    def enter(self):
+        """:return: whether the request is admitted, and must call leave()"""
+        return self.semaphore.acquire(False)
+
+    def leave(self):
+        self.semaphore.release()
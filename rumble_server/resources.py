@@ -1,8 +1,23 @@
-from flask import request
+import json
+
+from flask import request, Response, stream_with_context
 from flask_restful import Resource, abort
 from flask_restful.reqparse import RequestParser
 
+import server as server_module
 from server import get_instance
+from timeutil import format_iso
+
+
+def encoded_result(encoded, **fields):
+    """A dict(result=[...], **fields) response, from the JSON of each item of
+    the list
+    """
+    body = '{"result": [' + ', '.join(encoded) + ']'
+    for name, value in sorted(fields.iteritems()):
+        body += ', {}: {}'.format(json.dumps(name), json.dumps(value))
+    body += '}\n'
+    return Response(body, mimetype='application/json')
 
 
 def get_auth():
@@ -35,6 +50,14 @@ class Users(Resource):
         server = get_instance()
         return dict(result=server.get_users(user_auth=user_auth))
 
+    def post(self):
+        user_auth = get_auth()
+        parser = RequestParser()
+        parser.add_argument('users', type=list, location='json', required=True)
+        users = parser.parse_args()['users']
+        server = get_instance()
+        return dict(result=server.import_users(user_auth, users))
+
 
 class ActiveUser(Resource):
     def post(self):
@@ -110,10 +133,111 @@ class Message(Resource):
         return dict(result='OK')
 
 
+class MessageBatch(Resource):
+    def post(self):
+        user_auth = get_auth()
+        parser = RequestParser()
+        parser.add_argument('messages', type=list, location='json', required=True)
+        messages = parser.parse_args()['messages']
+        server = get_instance()
+        return dict(result=server.handle_messages(user_auth, messages))
+
+
 class Messages(Resource):
     def get(self, name, start, end):
         user_auth = get_auth()
         server = get_instance()
-        result = server.get_messages(user_auth, name, start, end)
-        result = [(k.isoformat(), v[0], v[1]) for k, v in result.iteritems()]
-        return dict(result=result)
+        return encoded_result(server.get_messages(user_auth, name, start, end, encoded=True))
+
+
+class MessagesSince(Resource):
+    def get(self, name, seq):
+        user_auth = get_auth()
+        parser = RequestParser()
+        parser.add_argument('limit', type=int, location='args', default=100)
+        limit = parser.parse_args()['limit']
+        server = get_instance()
+        result, has_more = server.get_messages_since(user_auth, name, seq, limit)
+        result = [(s, format_iso(t), h, m) for s, t, h, m in result]
+        cursor = result[-1][0] if result else seq
+        return dict(result=result, has_more=has_more, cursor=cursor)
+
+
+class NewMessages(Resource):
+    # Waits for messages, so it isn't counted against the concurrency cap
+    long_running = True
+
+    def get(self, name, since):
+        user_auth = get_auth()
+        parser = RequestParser()
+        parser.add_argument('timeout', type=float, location='args', default=30)
+        timeout = parser.parse_args()['timeout']
+        server = get_instance()
+        result, has_more, cursor = server.wait_for_messages(user_auth, name, since, timeout, encoded=True)
+        return encoded_result(result, has_more=has_more, cursor=cursor)
+
+
+class Sync(Resource):
+    def post(self):
+        user_auth = get_auth()
+        parser = RequestParser()
+        parser.add_argument('rooms', type=dict, location='json', default={})
+        parser.add_argument('version', type=int, location='json')
+        parser.add_argument('limit', type=int, location='json', default=100)
+        args = parser.parse_args()
+        try:
+            cursors = {name: int(seq) for name, seq in args['rooms'].iteritems()}
+        except (TypeError, ValueError):
+            abort(400, message='Room cursors must be sequence ids')
+        server = get_instance()
+        result = server.sync(user_auth, cursors, args['version'], args['limit'])
+
+        rooms = {}
+        for name, (messages, has_more, cursor) in result['rooms'].iteritems():
+            messages = [(s, format_iso(t), h, m) for s, t, h, m in messages]
+            rooms[name] = dict(result=messages, has_more=has_more, cursor=cursor)
+        result['rooms'] = rooms
+        if result['events'] is not None:
+            result['events'] = [dict(version=v, type=k, room=r, handle=h)
+                                for v, k, r, h in result['events']]
+        return result
+
+
+class Stream(Resource):
+    long_running = True
+
+    def get(self):
+        user_auth = get_auth()
+        parser = RequestParser()
+        parser.add_argument('room', type=str, location='args', action='append', required=True)
+        names = parser.parse_args()['room']
+        server = get_instance()
+        subscription = server.subscribe(user_auth, names)
+
+        def events():
+            try:
+                # Send something right away, so clients see the stream is open
+                yield ':\n\n'
+                while not subscription.overflowed:
+                    # Read first, so the events sent before it closed are all got
+                    closed = subscription.closed
+                    messages = subscription.get(0 if closed else server_module.stream_heartbeat_seconds)
+                    if not messages and closed is None:
+                        yield ':\n\n'
+                    for name, seq, timestamp, handle, message in messages:
+                        data = dict(room=name,
+                                    seq=seq,
+                                    timestamp=format_iso(timestamp),
+                                    handle=handle,
+                                    message=message)
+                        yield 'data: {}\n\n'.format(json.dumps(data))
+                    if closed is not None:
+                        # The session ended, the user left one of the rooms or
+                        # it was destroyed, so reconnecting as is won't do
+                        yield 'event: closed\ndata: {}\n\n'.format(json.dumps(dict(reason=closed)))
+                        return
+                yield 'event: overflow\ndata: {}\n\n'
+            finally:
+                server.unsubscribe(subscription)
+
+        return Response(stream_with_context(events()), mimetype='text/event-stream')
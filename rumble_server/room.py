@@ -1,19 +1,30 @@
+import threading
+
 from flask_restful import abort
 
 
 class Room(object):
-    def __init__(self, name, members, messages):
-        # List of invited members
+    def __init__(self, name, members, lock, id=None):
+        self.id = id
         self.name = name
+        # user id -> User
         self.members = members
-        self.messages = messages
+        # Resident blocks of history, block index -> Block (see history.py)
+        self.blocks = {}
+        # Sequence id and timestamp of the latest message, None until the
+        # history loads them
+        self.last_seq = None
+        self.last_timestamp = None
+        # Notified when a message is added or the room is destroyed. Shares
+        # the server lock, which waiters release while they wait
+        self.new_message = threading.Condition(lock)
 
-    def add_member(self, user_auth, user):
-        if user_auth in self.members:
+    def add_member(self, user):
+        if user.id in self.members:
             abort(400, message='User already in the room')
-        self.members[user_auth] = user
+        self.members[user.id] = user
 
-    def remove_member(self, user_auth):
-        if user_auth not in self.members:
+    def remove_member(self, user):
+        if user.id not in self.members:
             abort(404, message='User not found')
-        del self.members[user_auth]
+        del self.members[user.id]
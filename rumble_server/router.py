@@ -0,0 +1,346 @@
+"""Routes requests to the shards of a sharded deployment
+
+Rooms are spread over backend processes by a stable hash of their name.
+Each backend is a shard (see api.main --shard), serving the same database
+in shared mode, so users, sessions, rooms and memberships are known to
+all of them, while the history of a room is only held by its own shard.
+
+    python rumble_server/router.py --backend 127.0.0.1:5556 --backend 127.0.0.1:5557
+"""
+import argparse
+import hashlib
+import httplib
+import json
+import os
+import Queue
+import socket
+import threading
+import urllib
+
+from flask import Flask, Response, request, stream_with_context
+
+# Seconds between keep-alive comments on a merged stream
+stream_heartbeat_seconds = 15
+
+
+def shard_of(name, count):
+    """The shard of a room, the same in every process and on every run"""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return int(hashlib.md5(name).hexdigest()[:8], 16) % count
+
+
+class StreamConnection(httplib.HTTPConnection):
+    # The backends then stream without chunked encoding, and the response
+    # can be read line by line as events arrive
+    _http_vsn = 10
+    _http_vsn_str = 'HTTP/1.0'
+
+
+class Backend(object):
+    def __init__(self, address):
+        """A shard, with a keep-alive connection per request thread"""
+        self.address = address
+        self.local = threading.local()
+
+    def request(self, method, path, headers, body=None):
+        """Send a request, again on a new connection if it may not have arrived
+
+        A kept-alive connection may have been closed by the backend while
+        idle, and a request failing on it before any response was read
+        never reached the backend. Other failures are only retried for a
+        GET, as a POST or DELETE may have been carried out already.
+
+        :return: (status, headers, body)
+        """
+        for attempt in (1, 2):
+            conn = getattr(self.local, 'conn', None)
+            reused = conn is not None
+            if conn is None:
+                conn = self.local.conn = httplib.HTTPConnection(self.address)
+            response = None
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                return response.status, response.getheaders(), response.read()
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                self.local.conn = None
+                stale = reused and response is None
+                if attempt == 2 or not (stale or method == 'GET'):
+                    raise
+
+    def open_stream(self, path, headers):
+        """:return: (socket, response), shut the socket down to stop reading"""
+        conn = StreamConnection(self.address)
+        conn.request('GET', path, None, headers)
+        # The connection hands the socket over to the response
+        sock = conn.sock
+        return sock, conn.getresponse(buffering=True)
+
+
+def forwarded_headers():
+    headers = {}
+    for name in ('Authorization', 'Content-Type'):
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    # The router faces the clients, so any X-Forwarded-For they sent is
+    # replaced, and the shards can rate limit by it
+    headers['X-Forwarded-For'] = request.remote_addr
+    return headers
+
+
+def relay(status, headers, body):
+    headers = [(k, v) for k, v in headers
+               if k.lower() in ('content-type', 'retry-after')]
+    return Response(body, status, headers)
+
+
+def error(status_code, message):
+    return Response(json.dumps(dict(message=message)), status_code,
+                    mimetype='application/json')
+
+
+def read_events(response):
+    """Yield the server-sent events of a response, comments included"""
+    lines = []
+    while True:
+        line = response.fp.readline()
+        if not line:
+            return
+        if line.strip():
+            lines.append(line)
+            continue
+        if lines:
+            yield ''.join(lines) + '\n'
+        lines = []
+
+
+def create_router(backends):
+    """A WSGI app forwarding each request to the shards it concerns
+
+    Room routes go to the room's shard. The other routes don't depend on
+    rooms, and go to any shard, in turns. Message batches, syncs and
+    streams cover several rooms, so they are split between the shards
+    and their responses merged.
+    """
+    app = Flask(__name__)
+    backends = [Backend(address) for address in backends]
+    turns = [0]
+
+    def any_backend():
+        turns[0] = (turns[0] + 1) % len(backends)
+        return backends[turns[0]]
+
+    def owner(name):
+        return backends[shard_of(name, len(backends))]
+
+    def forward(backend):
+        path = request.full_path if request.query_string else request.path
+        try:
+            return backend.request(request.method, path, forwarded_headers(), request.get_data())
+        except (httplib.HTTPException, IOError):
+            return None
+
+    def scatter(calls):
+        """Forward to several backends at once
+
+        :param calls: [(backend, body), ...]
+        :return: a (status, headers, body), or None, per call
+        """
+        results = [None] * len(calls)
+        method = request.method
+        path = request.path
+        headers = forwarded_headers()
+
+        def call(i):
+            # Not forward(), as the request context is only in this thread
+            backend, body = calls[i]
+            try:
+                results[i] = backend.request(method, path, headers, body)
+            except (httplib.HTTPException, IOError):
+                pass
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in xrange(1, len(calls))]
+        for t in threads:
+            t.start()
+        call(0)
+        for t in threads:
+            t.join()
+        return results
+
+    def failed(results):
+        """:return: a response for the first failed call, or None"""
+        for result in results:
+            if result is None:
+                return error(502, 'Shard unavailable')
+            if result[0] != 200:
+                return relay(*result)
+        return None
+
+    def room_route(name, **kwargs):
+        result = forward(owner(name))
+        if result is None:
+            return error(502, 'Shard unavailable')
+        return relay(*result)
+
+    def global_route():
+        result = forward(any_backend())
+        if result is None:
+            return error(502, 'Shard unavailable')
+        return relay(*result)
+
+    def message_batch():
+        messages = (request.get_json(silent=True) or {}).get('messages')
+        if not isinstance(messages, list):
+            return global_route()
+        # shard -> indexes of its messages
+        parts = {}
+        for i, m in enumerate(messages):
+            name = m.get('room') if isinstance(m, dict) else None
+            shard = shard_of(name, len(backends)) if isinstance(name, basestring) else 0
+            parts.setdefault(shard, []).append(i)
+        shards = sorted(parts)
+        results = scatter([(backends[shard],
+                            json.dumps(dict(messages=[messages[i] for i in parts[shard]])))
+                           for shard in shards])
+        response = failed(results)
+        if response is not None:
+            return response
+        merged = [None] * len(messages)
+        for shard, (_, _, body) in zip(shards, results):
+            for i, item in zip(parts[shard], json.loads(body)['result']):
+                merged[i] = item
+        return Response(json.dumps(dict(result=merged)), mimetype='application/json')
+
+    def sync():
+        args = request.get_json(silent=True)
+        if not isinstance(args, dict) or not isinstance(args.get('rooms', {}), dict):
+            return global_route()
+        rooms = args.get('rooms', {})
+        # Every shard is asked, as joined rooms missing from the cursors
+        # are synced too. Events and their version come from the first
+        calls = []
+        for shard, backend in enumerate(backends):
+            body = dict(args, rooms={name: seq for name, seq in rooms.iteritems()
+                                     if shard_of(name, len(backends)) == shard})
+            if shard > 0:
+                body.pop('version', None)
+            calls.append((backend, json.dumps(body)))
+        results = scatter(calls)
+        response = failed(results)
+        if response is not None:
+            return response
+        results = [json.loads(body) for _, _, body in results]
+        merged = results[0]
+        for result in results[1:]:
+            merged['rooms'].update(result['rooms'])
+            if merged['events'] is None:
+                merged['members'].update(result['members'])
+        return Response(json.dumps(merged), mimetype='application/json')
+
+    def stream():
+        # shard -> names of its rooms
+        parts = {}
+        for name in request.args.getlist('room'):
+            parts.setdefault(shard_of(name, len(backends)), []).append(name)
+        if not parts:
+            return global_route()
+        headers = forwarded_headers()
+        connections = []
+        stopped = threading.Event()
+
+        def close():
+            stopped.set()
+            for sock, _ in connections:
+                try:
+                    # Wakes up a reader waiting for the next event
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                sock.close()
+
+        try:
+            for shard, names in sorted(parts.iteritems()):
+                path = '/stream?' + urllib.urlencode([('room', n) for n in names])
+                connections.append(backends[shard].open_stream(path, headers))
+        except (httplib.HTTPException, IOError):
+            close()
+            return error(502, 'Shard unavailable')
+        for _, response in connections:
+            if response.status != 200:
+                close()
+                return relay(response.status, response.getheaders(), response.read())
+
+        queue = Queue.Queue()
+
+        def read(response):
+            try:
+                for event in read_events(response):
+                    if stopped.is_set():
+                        break
+                    # The shards' keep-alive comments are replaced by ours
+                    if not event.startswith(':'):
+                        queue.put(event)
+            except (IOError, ValueError):
+                # Closed by the other side, or by close() below
+                pass
+            finally:
+                # Only now is the socket really closed, once its file is
+                response.close()
+                queue.put(None)
+
+        for _, response in connections:
+            t = threading.Thread(target=read, args=(response,))
+            t.daemon = True
+            t.start()
+
+        def events():
+            try:
+                yield ':\n\n'
+                while True:
+                    try:
+                        event = queue.get(timeout=stream_heartbeat_seconds)
+                    except Queue.Empty:
+                        yield ':\n\n'
+                        continue
+                    if event is None:
+                        # A shard ended its stream, the client has to reconnect
+                        break
+                    yield event
+                    if event.startswith(('event: overflow', 'event: closed')):
+                        break
+            finally:
+                close()
+
+        return Response(stream_with_context(events()), mimetype='text/event-stream')
+
+    methods = ['GET', 'POST', 'DELETE']
+    for route in ('/room/<name>',
+                  '/room_member/<name>',
+                  '/room_members/<name>',
+                  '/message/<name>',
+                  '/messages/<name>/<start>/<end>',
+                  '/messages_since/<name>/<seq>',
+                  '/new_messages/<name>/<since>'):
+        app.add_url_rule(route, route, room_route, methods=methods)
+    for route in ('/user', '/users', '/active_user', '/rooms'):
+        app.add_url_rule(route, route, global_route, methods=methods)
+    app.add_url_rule('/message_batch', 'message_batch', message_batch, methods=['POST'])
+    app.add_url_rule('/sync', 'sync', sync, methods=['POST'])
+    app.add_url_rule('/stream', 'stream', stream)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', action='append', required=True,
+                        help='host:port of a shard, in the order of their --shard index')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5555)))
+    args = parser.parse_args()
+    create_router(args.backend).run(host='0.0.0.0', port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
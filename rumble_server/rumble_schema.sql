@@ -4,23 +4,53 @@ CREATE TABLE IF NOT EXISTS room(
 id INTEGER PRIMARY KEY,
 name TEXT);
 
+CREATE UNIQUE INDEX IF NOT EXISTS room_name ON room(name);
+
 CREATE TABLE IF NOT EXISTS user(
 id INTEGER PRIMARY KEY,
 name TEXT,
 password TEXT,
 handle TEXT);
 
+CREATE UNIQUE INDEX IF NOT EXISTS user_name ON user(name);
+CREATE UNIQUE INDEX IF NOT EXISTS user_handle ON user(handle);
+
 CREATE TABLE IF NOT EXISTS membership(
 id INTEGER PRIMARY KEY,
 user_id references user(id),
 room_id references room(id));
 
+CREATE UNIQUE INDEX IF NOT EXISTS membership_user_room ON membership(user_id, room_id);
+
+CREATE TABLE IF NOT EXISTS session(
+token TEXT PRIMARY KEY,
+user_id references user(id));
+
+CREATE TABLE IF NOT EXISTS change(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+origin TEXT,
+timestamp INTEGER,
+kind TEXT,
+data TEXT);
+
+CREATE TABLE IF NOT EXISTS process(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+origin TEXT,
+started INTEGER);
+
+CREATE TABLE IF NOT EXISTS snapshot(
+token TEXT);
+
 CREATE TABLE IF NOT EXISTS message(
 id INTEGER PRIMARY KEY,
 room_id references room(id),
 user_id references user(id),
-timestamp TEXT,
-message TEXT);
+timestamp INTEGER,
+message TEXT,
+seq INTEGER);
+
+CREATE INDEX IF NOT EXISTS message_room_timestamp ON message(room_id, timestamp);
+CREATE UNIQUE INDEX IF NOT EXISTS message_room_seq ON message(room_id, seq);
 
 INSERT INTO room (name) VALUES ('room0');
 
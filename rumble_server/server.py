@@ -1,23 +1,139 @@
+import json
+import logging
+import math
 import os
 import sqlite3
+import threading
+import time
 import uuid
-import datetime
-import dateutil.parser
+import functools
 from flask_restful import abort
+from db import Database, StatementStats
+from events import EventLog
+import feed
+from history import History
+from memberships import Memberships
+from pubsub import Broker
 from room import Room
+from router import shard_of
+from sessions import Sessions
+import snapshot
+import timeutil
 from user import User
-from collections import OrderedDict
+from writer import MessageWriter
+
+logger = logging.getLogger(__name__)
 
 instance = None
 script_dir = os.path.dirname(__file__)
 db_path = os.path.join(os.path.join(script_dir, 'rumble.db'))
 schema_file = os.path.join(os.path.join(script_dir, 'rumble_schema.sql'))
+# Room history is loaded on demand in blocks of this many sequence ids
+block_size = 256
+# Memory budget for resident history blocks, in messages
+max_cached_messages = 100000
+# Upper bound on the number of messages returned by one cursor fetch
+max_fetch_limit = 1000
+# Upper bound, in seconds, on how long a request may wait for new messages
+max_wait_seconds = 60
+# Stream subscribers further behind than this many events are dropped
+max_pending_events = 1000
+# Seconds between keep-alive comments on idle streams
+stream_heartbeat_seconds = 15
+# New messages are written to the database in the background, at most this
+# many seconds after they are sent and at most this many per transaction
+flush_interval = 0.1
+max_batch_size = 1000
+# Upper bound on the number of messages sent in one message batch
+max_batch_messages = 1000
+# Usernames of the users allowed to import users (see api.main --admin), and
+# the most users one import may register
+user_admins = frozenset()
+max_import_users = 1000
+# Number of database connections shared by the request threads
+pool_size = 4
+# Room and membership changes kept for clients to sync from
+max_sync_events = 10000
+# Rate limits, as (requests per second, burst), by resource class, for each
+# auth token and for each client IP address. Classes not listed are not limited
+token_rate_limits = dict(
+    Message=(10, 50),
+    MessageBatch=(2, 10),
+    Messages=(20, 100),
+    MessagesSince=(20, 100),
+    NewMessages=(5, 20),
+    Sync=(5, 20),
+    Stream=(1, 5),
+)
+ip_rate_limits = dict(
+    User=(1, 20),
+    ActiveUser=(2, 20),
+    Message=(50, 250),
+    MessageBatch=(10, 50),
+    Messages=(100, 500),
+    MessagesSince=(100, 500),
+    NewMessages=(25, 100),
+    Sync=(25, 100),
+    Stream=(5, 25),
+)
+# Requests handled at once, not counting long polls and streams, beyond which
+# requests are turned away before they reach the database
+max_concurrent_requests = 64
+# Whether a user may stay logged in from several clients at once
+multiple_sessions = False
+# Whether several processes serve the same database (see api.main --workers).
+# Sessions are then stored in the database, messages are written as they are
+# sent, taking their seq from the database, and every change is recorded for
+# the other processes to follow
+shared = False
+# Event versions of one process in shared mode. Each process start takes
+# the next epoch, which keeps versions below 2 ** 53, for JavaScript
+# clients, for about two million process starts
+events_per_epoch = 2 ** 32
+# Seconds between polls for the changes of other processes, and how long
+# changes are kept for them
+feed_interval = 0.05
+change_retention_seconds = 3600
+# (index, count) when this process is one of the shards behind the router
+# (see api.main --shard). Syncs then only cover the rooms of this shard
+shard = None
+# Seconds between snapshots of the users, rooms, memberships and sessions.
+# With the journal of the changes since, they let the server restart
+# without reloading from the database, and keep clients logged in. None
+# turns them off. Not used in shared mode, where the database has the state
+snapshot_interval = 300
 
 
 def get_db_path():
     return db_path
 
 
+def get_snapshot_path():
+    return get_db_path() + '.snapshot'
+
+
+def timed(f):
+    """Record the calls and cumulative seconds of a Server method"""
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            self.method_stats.record(f.__name__, time.time() - start)
+    return wrapper
+
+
+def synchronized(f):
+    """Run a Server method while holding the server lock"""
+    @timed
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return f(self, *args, **kwargs)
+    return wrapper
+
+
 def get_instance():
     global instance
     if instance is None:
@@ -26,73 +142,492 @@ def get_instance():
 
 
 class Server(object):
+    # Runs the statements, see cooperative.CooperativeServer
+    database_class = Database
+
     def __init__(self):
-        self.conn = sqlite3.connect(get_db_path())
+        self.db_stats = StatementStats()
+        # Server methods, including the time spent waiting for the lock
+        self.method_stats = StatementStats()
+        self.db = self.database_class(get_db_path(), self.db_stats, pool_size)
+        # Requests are served on multiple threads. The lock guards the
+        # in-memory state (rooms, users, logged_in_users and the history)
+        self.lock = threading.RLock()
         self.rooms = {}
+        # username -> User and handle -> User
         self.users = {}
-        self.logged_in_users = {}
-        self._load_all_users()
-        self._load_all_rooms()
+        self.users_by_handle = {}
+        # Messages refer to their sender by user id
+        self.users_by_id = {}
+        self.logged_in_users = Sessions(multiple_sessions, self._load_session if shared else None)
+        self.memberships = Memberships()
+        self.events = EventLog(max_sync_events)
+        self.broker = Broker(max_pending_events)
+        self.writer = MessageWriter(get_db_path(), self.db_stats, flush_interval, max_batch_size,
+                                    self.database_class)
+        self.writer.start()
+        self.history = History(self.db, self.writer, block_size, max_cached_messages)
+        # Tells this process' changes apart from those of other processes
+        self.origin = uuid.uuid4().hex
+        self.feed = None
+        self.snapshots = None
+        self.snapshotter = None
+        self._migrate()
+        self._create_indexes()
+        if shared:
+            # Changes made while loading are applied again, which is harmless
+            with self.db:
+                cursor = self.db.query('select_last_change')[0][0]
+                # Each process numbers its own events. Versions start after
+                # a number unique to the process, so a version from another
+                # process, or from before a restart, is never taken for one
+                # of this process' and the client gets the full state
+                epoch = self.db.execute('insert_process', (self.origin, timeutil.now())).lastrowid
+            self.events = EventLog(max_sync_events, epoch * events_per_epoch)
+        if snapshot_interval and not shared:
+            self.snapshots = snapshot.Snapshots(get_snapshot_path())
+        if self._load_snapshot():
+            # Changes go to a new journal, replayed after the current ones
+            self.snapshots.rotate()
+        else:
+            self._load_all_users()
+            self._load_all_rooms()
+            self._load_all_memberships()
+            if self.snapshots is not None:
+                self.save_snapshot()
+        if self.snapshots is not None:
+            self.snapshotter = snapshot.Snapshotter(self.snapshots, self.save_snapshot,
+                                                    snapshot_interval)
+            self.snapshotter.start()
+        if shared:
+            self.feed = feed.ChangeFeed(get_db_path(), self.db_stats, cursor, self.origin,
+                                        self.apply_changes, feed_interval,
+                                        change_retention_seconds, self.database_class)
+            self.feed.start()
 
     def get_auth_by_user(self, user):
-        for k,v in self.logged_in_users.iteritems():
-            if v == user:
-                return k
-        return None
+        return next(iter(self.logged_in_users.tokens(user)), None)
+
+    def get_db_stats(self):
+        """:return: {statement name: (calls, cumulative seconds)}"""
+        return self.db_stats.snapshot()
+
+    def get_method_stats(self):
+        """:return: {Server method name: (calls, cumulative seconds)}"""
+        return self.method_stats.snapshot()
+
+    @synchronized
+    def get_memory_stats(self):
+        """:return: dict(rooms=<count>, sessions=<count>,
+                         messages={room name: resident messages},
+                         history_bytes=<approximate size of the resident history>)
+        """
+        sizes = self.history.sizes()
+        return dict(rooms=len(self.rooms),
+                    sessions=len(self.logged_in_users),
+                    messages={name: sizes.get(name, (0, 0))[0] for name in self.rooms},
+                    history_bytes=sum(size for _, size in sizes.itervalues()))
+
+    @synchronized
+    def get_cache_stats(self):
+        """:return: hits and misses of the cached JSON of history blocks"""
+        return dict(hits=self.history.encoded_hits, misses=self.history.encoded_misses)
 
     def disconnect(self):
-        self.conn.close()
+        if self.feed is not None:
+            self.feed.close()
+        if self.snapshotter is not None:
+            self.snapshotter.close()
+            if self.snapshots.changes:
+                self.save_snapshot()
+            self.snapshots.close()
+        self.writer.close()
+        self.db.close()
 
-    def _load_all_rooms(self):
+    def _migrate(self):
+        """Bring databases created by older versions up to date
+
+        Messages are numbered if they predate sequence ids, and text
+        timestamps are converted to microseconds since the epoch. It all
+        happens in one transaction, so a crash leaves the database as it was.
         """
+        with self.db.schema_transaction():
+            self.db.execute('create_membership_table')
+            self.db.execute('create_session_table')
+            self.db.execute('create_change_table')
+            self.db.execute('create_process_table')
+            self.db.execute('create_snapshot_table')
+            columns = {c[1]: c[2] for c in self.db.query('select_message_columns')}
+            if 'seq' not in columns:
+                self.db.execute('add_message_seq')
+                seqs = {}
+                rows = []
+                for id, room_id in self.db.query('select_message_ids'):
+                    seqs[room_id] = seqs.get(room_id, 0) + 1
+                    rows.append((seqs[room_id], id))
+                self.db.executemany('set_message_seq', rows)
+            if columns['timestamp'].upper() != 'INTEGER':
+                # SQLite can't change the type of a column, so the table is
+                # rebuilt, and its indexes are recreated by _create_indexes
+                self.db.execute('drop_migrated_message_table')
+                self.db.execute('create_message_table')
+                rows = [(id, room_id, user_id, timeutil.parse_iso(timestamp), message, seq)
+                        for id, room_id, user_id, timestamp, message, seq
+                        in self.db.query('select_messages')]
+                self.db.executemany('insert_migrated_message', rows)
+                self.db.execute('drop_message_table')
+                self.db.execute('rename_message_table')
+
+    def _create_indexes(self):
+        with self.db:
+            self.db.execute('create_message_index')
+            self.db.execute('create_message_seq_index')
+            self.db.execute('create_room_name_index')
+            self.db.execute('create_user_name_index')
+            self.db.execute('create_user_handle_index')
+            self.db.execute('create_membership_index')
+
+    def _load_all_rooms(self):
+        """Load room metadata only, history is loaded on demand by self.history
+
         :return:
         """
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("SELECT * FROM room")
-            rooms = cur.fetchall()
+        with self.db:
+            rooms = self.db.query('select_rooms')
             for r in rooms:
-                cur.execute("SELECT * FROM message WHERE room_id = {}".format(r[0]))
-                room_messages = cur.fetchall()
-                messages = {}
-                for m in room_messages:
-                    cur.execute("SELECT handle FROM user WHERE id = {}".format(m[2]))
-                    handle = cur.fetchone()[0]
-                    timestamp = dateutil.parser.parse(m[3])
-                    messages[timestamp] = (handle, m[4])
+                self.rooms[r[1]] = Room(r[1], {}, self.lock, r[0])
+
+    def _load_all_memberships(self):
+        rooms_by_id = {room.id: room for room in self.rooms.itervalues()}
+        with self.db:
+            for user_id, room_id in self.db.query('select_memberships'):
+                room = rooms_by_id.get(room_id)
+                user = self._get_user_by_id(user_id)
+                if room is not None and user is not None:
+                    self.memberships.add(room, user)
+
+    def _load_snapshot(self):
+        """Load the state from the snapshot and replay the journal
+
+        The snapshot is only used if it was taken of this database, and
+        nothing was added to the database since that it doesn't know of.
+        Otherwise, it is removed and a new one taken of this database.
+
+        :return: whether the state was loaded
+        """
+        if self.snapshots is None:
+            return False
+        state, changes = self.snapshots.load()
+        with self.db:
+            rows = self.db.query('select_snapshot_token')
+        if state is not None and rows and state['token'] == rows[0][0]:
+            for id, username, password, handle in state['users']:
+                self._add_user(User(username, password, handle, True, id))
+            rooms_by_id = {}
+            for id, name in state['rooms']:
+                rooms_by_id[id] = self.rooms[name] = Room(name, {}, self.lock, id)
+            for user_id, room_id in state['memberships']:
+                self.memberships.add(rooms_by_id[room_id], self.users_by_id[user_id])
+            for user_auth, user_id in state['sessions']:
+                self.logged_in_users.add(user_auth, self.users_by_id[user_id])
+            # Versions clients got before the restart stay valid, as the
+            # replayed changes append the same events again
+            self.events.version = state['events']
+            self.apply_changes(changes)
+
+            with self.db:
+                max_ids = tuple(self.db.query('select_max_ids')[0])
+            room_ids = [room.id for room in self.rooms.itervalues()]
+            if max_ids == (max(self.users_by_id or [0]), max(room_ids or [0])):
+                self.snapshot_token = state['token']
+                return True
+            logger.warning('The snapshot is behind the database, loading from the database')
+            self._clear_state()
+
+        self.snapshots.reset()
+        self.snapshot_token = uuid.uuid4().hex
+        with self.db:
+            self.db.execute('delete_snapshot_token')
+            self.db.execute('insert_snapshot_token', (self.snapshot_token,))
+        return False
+
+    def _clear_state(self):
+        self.rooms.clear()
+        self.users.clear()
+        self.users_by_handle.clear()
+        self.users_by_id.clear()
+        self.logged_in_users = Sessions(multiple_sessions)
+        self.memberships = Memberships()
+        self.events = EventLog(max_sync_events)
+
+    def save_snapshot(self):
+        """Snapshot the users, rooms, memberships and sessions
+
+        The state is copied with the lock held, and written without it.
+        """
+        state, generation = self._copy_state()
+        self.snapshots.write(state, generation)
+
+    @synchronized
+    def _copy_state(self):
+        """:return: (the state to snapshot, its generation)"""
+        state = dict(token=self.snapshot_token,
+                     events=self.events.version,
+                     users=[(u.id, u.username, u.password, u.handle)
+                            for u in self.users_by_id.itervalues()],
+                     rooms=[(r.id, r.name) for r in self.rooms.itervalues()],
+                     memberships=[(user_id, r.id) for r in self.rooms.itervalues()
+                                  for user_id in r.members],
+                     sessions=[(user_auth, u.id)
+                               for user_auth, u in self.logged_in_users.by_token.iteritems()])
+        generation = self.snapshots.rotate()
+        return state, generation
+
+    def _journal(self, kind, *data):
+        """Journal a change of the in-memory state, for the next restart"""
+        if self.snapshots is not None:
+            self.snapshots.append(kind, *data)
+
+    def _record(self, kind, *data):
+        """Record a change for the other processes, in the current transaction
+        """
+        if shared:
+            feed.record(self.db, self.origin, kind, *data)
+
+    @synchronized
+    def apply_changes(self, changes):
+        """Apply the changes of other processes, or of the journal, to the
+        in-memory state
+
+        Changes may be applied more than once, e.g. the ones made while
+        the server was loading, so applying one is a no-op if its effect is
+        already there.
+
+        :param changes: [(kind, data), ...] in the order they were made
+        """
+        # room name -> latest seq and timestamp
+        messages = {}
+        for kind, data in changes:
+            if kind == 'message':
+                name, seq, timestamp = data
+                if seq > messages.get(name, (0, 0))[0]:
+                    messages[name] = seq, timestamp
+                continue
+            # Messages before a room change are applied before it
+            self._apply_messages(messages)
+            messages = {}
+            if kind == 'room_created':
+                name, id = data
+                if name not in self.rooms:
+                    self.rooms[name] = Room(name, {}, self.lock, id)
+                    self.events.append(kind, name)
+            elif kind == 'room_destroyed':
+                name, = data
+                room = self.rooms.pop(name, None)
+                if room is not None:
+                    self.memberships.drop_room(room)
+                    self.events.append(kind, name)
+                    self.history.drop_room(room)
+                    self.broker.drop_room(name)
+                    room.new_message.notify_all()
+            elif kind in ('member_joined', 'member_left'):
+                name, user_id = data
+                room = self.rooms.get(name)
+                user = self._get_user_by_id(user_id)
+                if room is None or user is None or (user.id in room.members) == (kind == 'member_joined'):
+                    continue
+                if kind == 'member_joined':
+                    self.memberships.add(room, user)
+                else:
+                    self.memberships.remove(room, user)
+                    self.broker.close_member(user.id, name)
+                self.events.append(kind, name, user.handle)
+            elif kind == 'user_registered':
+                id, username, password, handle = data
+                if id not in self.users_by_id:
+                    self._add_user(User(username, password, handle, True, id))
+            elif kind == 'session_started':
+                user_auth, user_id = data
+                user = self._get_user_by_id(user_id)
+                if user is not None and user_auth not in self.logged_in_users.by_token:
+                    for token in self.logged_in_users.add(user_auth, user):
+                        self.broker.close_session(user.id, token)
+            elif kind == 'session_ended':
+                user_auth, = data
+                if user_auth in self.logged_in_users.by_token:
+                    user = self.logged_in_users.remove(user_auth)
+                    self.broker.close_session(user.id, user_auth)
+            elif kind == 'sessions_replaced':
+                user_id, user_auth = data
+                user = self.users_by_id.get(user_id)
+                if user is not None:
+                    for token in list(self.logged_in_users.tokens(user)):
+                        if token != user_auth:
+                            self.logged_in_users.remove(token)
+                            self.broker.close_session(user.id, token)
+        self._apply_messages(messages)
+
+    def _apply_messages(self, messages):
+        """Catch up with the messages other processes added to rooms
+
+        :param messages: {room name: (latest seq, its timestamp)}
+        """
+        for name, (seq, timestamp) in messages.iteritems():
+            room = self.rooms.get(name)
+            # Rooms whose tail isn't loaded yet will load it with the messages
+            if room is None or room.last_seq is None or seq <= room.last_seq:
+                continue
+            first = room.last_seq + 1
+            self.history.forget_after(room, room.last_seq)
+            room.last_seq = seq
+            room.last_timestamp = timestamp
+            room.new_message.notify_all()
+            if self.broker.has_subscribers(name):
+                for m in self._with_handles(self.history.get_range(room, first, seq + 1)):
+                    self.broker.publish(name, (name,) + m)
+
+    def _load_session(self, user_auth):
+        """:return: the User of a session another process started, or None"""
+        with self.db:
+            rows = self.db.query('select_session', (user_auth,))
+        return self._get_user_by_id(rows[0][0]) if rows else None
+
+    def _get_user(self, username):
+        """:return: the User, or None. If shared, users another process
+                    registered are looked up in the database.
+        """
+        user = self.users.get(username)
+        if user is None and shared:
+            user = self._load_user('select_user_by_name', username)
+        return user
 
-                self.rooms[r[1]] = Room(r[1], {}, messages)
+    def _get_user_by_id(self, id):
+        user = self.users_by_id.get(id)
+        if user is None and shared:
+            user = self._load_user('select_user_by_id', id)
+        return user
+
+    def _load_user(self, statement, key):
+        with self.db:
+            rows = self.db.query(statement, (key,))
+        if not rows:
+            return None
+        id, username, password, handle = rows[0]
+        user = User(username, password, handle, True, id)
+        self._add_user(user)
+        return user
+
+    def _with_handles(self, messages):
+        """[(seq, timestamp, sender, text), ...] -> [(seq, timestamp, handle, text), ...]
+        """
+        return [(seq, timestamp, self._get_user_by_id(sender).handle, text)
+                for seq, timestamp, sender, text in messages]
+
+    def _parse_timestamp(self, text):
+        """:return: the microseconds since the epoch of a timestamp a client sent"""
+        try:
+            return timeutil.parse_iso(text)
+        except (ValueError, OverflowError):
+            abort(400, message='Invalid timestamp')
+
+    def _encode(self, seq, timestamp, sender, text):
+        """The JSON of a message in responses, [timestamp, handle, message]"""
+        return json.dumps((timeutil.format_iso(timestamp), self._get_user_by_id(sender).handle, text))
 
     def _load_all_users(self):
         """
         :return:
         """
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("SELECT * FROM user")
-            users = cur.fetchall()
+        with self.db:
+            users = self.db.query('select_users')
             for u in users:
-                user = User(u[1], u[2], u[3], True)
-                self.users[u[1]] = user
+                user = User(u[1], u[2], u[3], True, u[0])
+                self._add_user(user)
+
+    def _add_user(self, user):
+        self.users[user.username] = user
+        self.users_by_handle[user.handle] = user
+        self.users_by_id[user.id] = user
 
+    def _check_new_user(self, username, handle):
+        """:return: why a new user can't have this username or handle, or None
+        """
+        if username in self.users:
+            return 'Username {} is already taken'.format(username)
+        if handle in self.users_by_handle:
+            return 'Handle {} is already taken'.format(handle)
+        return None
+
+    @synchronized
     def register(self, username, password, handle):
         """
         :return:
         """
-        for name, user in self.users.iteritems():
-            if name == username:
+        message = self._check_new_user(username, handle)
+        if message is not None:
+            abort(400, message=message)
+        try:
+            with self.db:
+                cur = self.db.execute('insert_user', (username, password, handle))
+        except sqlite3.IntegrityError:
+            # Taken by a user that isn't loaded, e.g. from another process
+            abort(400, message='Username {} or handle {} is already taken'.format(username, handle))
+        self._add_user(User(username, password, handle, True, cur.lastrowid))
+        self._journal('user_registered', cur.lastrowid, username, password, handle)
+
+    @synchronized
+    def import_users(self, user_auth, users):
+        """Register many users in one transaction
+
+        :param users: [dict(username=..., password=..., handle=...), ...]
+        :return: a dict(result='OK') or dict(message=<error>) per user
+        """
+        user_auth = str(user_auth)
+        if user_auth not in self.logged_in_users:
+            abort(401, message='Unauthorized user')
+        if self.logged_in_users[user_auth].username not in user_admins:
+            abort(403, message='Only admins can import users')
+        if len(users) > max_import_users:
+            abort(400, message='Too many users, at most {} per import'.format(max_import_users))
+
+        results = []
+        new_users = []
+        usernames = set()
+        handles = set()
+        for u in users:
+            try:
+                username, password, handle = u['username'], u['password'], u['handle']
+            except (KeyError, TypeError):
+                username = password = handle = None
+            if not all(isinstance(x, basestring) for x in (username, password, handle)):
+                results.append(dict(message='A username, password and handle are required'))
+                continue
+            message = self._check_new_user(username, handle)
+            if message is None and username in usernames:
                 message = 'Username {} is already taken'.format(username)
-                abort(400, message=message)
-            if user.handle == handle:
+            if message is None and handle in handles:
                 message = 'Handle {} is already taken'.format(handle)
-                abort(400, message=message)
-        new_user = User(username, password, handle, True)
-        self.users[username] = new_user
+            if message is not None:
+                results.append(dict(message=message))
+                continue
+            usernames.add(username)
+            handles.add(handle)
+            new_users.append(User(username, password, handle, True))
+            results.append(dict(result='OK'))
 
-        with self.conn:
-            db = self.conn.cursor()
-            db.execute("INSERT INTO user (name, password, handle) VALUES('{}', '{}', '{}')".format(username, password, handle))
+        try:
+            with self.db:
+                for user in new_users:
+                    cur = self.db.execute('insert_user', (user.username, user.password, user.handle))
+                    user.id = cur.lastrowid
+        except sqlite3.IntegrityError:
+            abort(400, message='Some usernames or handles are already taken')
+        for user in new_users:
+            self._add_user(user)
+            self._journal('user_registered', user.id, user.username, user.password, user.handle)
+        return results
 
+    @synchronized
     def login(self, username, password):
         """
 
@@ -102,18 +637,25 @@ class Server(object):
         """
         username = unicode(username)
         password = unicode(password)
-        target_user = self.users.get(username, None)
+        target_user = self._get_user(username)
         if target_user is None or password != target_user.password:
             abort(401, message='Invalid username or password')
 
-        auth = self.get_auth_by_user(target_user)
-        if auth is not None:
-            self.logout(auth)
-
+        # Replaces the user's previous session, unless multiple_sessions is set
         user_auth = uuid.uuid4().hex
-        self.logged_in_users[user_auth] = target_user
+        for token in self.logged_in_users.add(user_auth, target_user):
+            # Their streams end with them
+            self.broker.close_session(target_user.id, token)
+        if shared:
+            with self.db:
+                if not multiple_sessions:
+                    self.db.execute('delete_user_sessions', (target_user.id,))
+                    self._record('sessions_replaced', target_user.id, user_auth)
+                self.db.execute('insert_session', (user_auth, target_user.id))
+        self._journal('session_started', user_auth, target_user.id)
         return user_auth
 
+    @synchronized
     def logout(self, user_auth):
         """
 
@@ -125,8 +667,15 @@ class Server(object):
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized User')
 
-        del self.logged_in_users[user_auth]
+        user = self.logged_in_users.remove(user_auth)
+        self.broker.close_session(user.id, user_auth)
+        self._journal('session_ended', user_auth)
+        if shared:
+            with self.db:
+                self.db.execute('delete_session', (user_auth,))
+                self._record('session_ended', user_auth)
 
+    @synchronized
     def handle_message(self, user_auth, name, message):
         """
         :return:
@@ -137,103 +686,360 @@ class Server(object):
         if name not in self.rooms:
             abort(404, message='Room not found')
         room = self.rooms[name]
-        if user_auth not in room.members:
+        if self.logged_in_users[user_auth].id not in room.members:
             abort(401, message='Only members can send messages')
 
-        handle = self.logged_in_users[user_auth].handle
-        timestamp = datetime.datetime.utcnow().replace(microsecond=0)
+        sender = self.logged_in_users[user_auth]
+        row = self._append(room, sender, message)
+        if row is not None:
+            self.writer.put(row)
 
-        room.messages[timestamp]= (handle, message)
+    @synchronized
+    def handle_messages(self, user_auth, messages):
+        """Send many messages, to one or more rooms, in one go
 
-        with self.conn:
-            db = self.conn.cursor()
-            # Find sender's user_id in Db by user name
-            db.execute("SELECT id FROM user WHERE handle = '{}'".format(handle))
-            sender_id = db.fetchone()[0]
-            # Find room_id in Db by room name
-            db.execute("SELECT id FROM room WHERE name = '{}'".format(name))
-            room_id = db.fetchone()[0]
-            # Save message to DB
-            cmd = "INSERT INTO message (room_id, user_id, timestamp, message) VALUES({}, {}, '{}', '{}')"
-            cmd = cmd.format(room_id, sender_id, timestamp, message)
-            db.execute(cmd)
+        Every valid message is appended before any other request in this
+        process sees the room, and they are all written in the same
+        transaction.
 
-    def get_messages(self, user_auth, name, start=None, end=None):
+        :param messages: [dict(room=..., message=...), ...]
+        :return: a dict(result='OK', seq=<seq>) or dict(message=<error>) per
+                 message
+        """
+        user_auth = str(user_auth)
+        if user_auth not in self.logged_in_users:
+            abort(401, message='Unauthorized user')
+        if len(messages) > max_batch_messages:
+            abort(400, message='Too many messages, at most {} per batch'.format(max_batch_messages))
+        sender = self.logged_in_users[user_auth]
+        if shared:
+            with self.db:
+                results, _ = self._append_all(user_auth, sender, messages)
+        else:
+            results, rows = self._append_all(user_auth, sender, messages)
+            self.writer.put_many(rows)
+        return results
+
+    def _append_all(self, user_auth, sender, messages):
+        """:return: (a result per message, the rows for the writer to store)"""
+        results = []
+        rows = []
+        for m in messages:
+            try:
+                name, message = m['room'], m['message']
+            except (KeyError, TypeError):
+                name = message = None
+            if not isinstance(name, basestring) or not isinstance(message, basestring):
+                results.append(dict(message='A room and a message are required'))
+                continue
+            room = self.rooms.get(name)
+            if room is None:
+                results.append(dict(message='Room not found'))
+                continue
+            if self.logged_in_users[user_auth].id not in room.members:
+                results.append(dict(message='Only members can send messages'))
+                continue
+            row = self._append(room, sender, message)
+            if row is not None:
+                rows.append(row)
+            results.append(dict(result='OK', seq=room.last_seq))
+        return results, rows
+
+    def _append(self, room, sender, message):
+        """Append a message to a room and notify waiters and subscribers
+
+        :return: the row for the writer to store, or None if shared, as the
+                 message is then already written
+        """
+        self.history.load_tail(room)
+        if shared:
+            # The database has the room's latest seq and timestamp, which
+            # another process may have taken
+            with self.db:
+                cur = self.db.execute('insert_next_message',
+                                      (room.id, sender.id, timeutil.now(), message, room.id))
+                seq, timestamp = self.db.query('select_message_seq', (cur.lastrowid,))[0]
+                self._record('message', room.name, seq, timestamp)
+            # Catch up with the messages other processes added in between
+            self._apply_messages({room.name: (seq - 1, timestamp)})
+            row = None
+        else:
+            seq = room.last_seq + 1
+            # Timestamps increase with seq, even if the clock goes back
+            timestamp = max(timeutil.now(), room.last_timestamp + 1)
+            row = (room.id, sender.id, seq, timestamp, message)
+        room.last_seq = seq
+        room.last_timestamp = timestamp
+
+        self.history.add_message(room, seq, timestamp, sender.id, message)
+        room.new_message.notify_all()
+        self.broker.publish(room.name, (room.name, seq, timestamp, sender.handle, message))
+        return row
+
+    @synchronized
+    def get_messages(self, user_auth, name, start=None, end=None, encoded=False):
+        """
+        :return: [(seq, timestamp, handle, message), ...], or with encoded
+                 the JSON of each message as self._encode makes it
+        """
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized user')
         if name not in self.rooms:
             abort(404, message='Room not found')
         room = self.rooms[name]
-        if user_auth not in room.members:
+        if self.logged_in_users[user_auth].id not in room.members:
             abort(401, message='Only members can receive messages')
 
-        start = dateutil.parser.parse(start)
-        end = dateutil.parser.parse(end)
-        start = start.replace(tzinfo=None)
-        end = end.replace(tzinfo=None)
+        start = self._parse_timestamp(start)
+        end = self._parse_timestamp(end)
+        first = self.history.find_seq(room, start)
+        end = self.history.find_seq(room, end)
+        if encoded:
+            return self.history.get_encoded(room, first, end, self._encode)
+        return self._with_handles(self.history.get_range(room, first, end))
 
-        messages = {k: v for k, v in room.messages.iteritems() if start <= k < end}
-        messages = OrderedDict(sorted(messages.items(), key=lambda t: t[0]))
-        return messages
+    @synchronized
+    def get_messages_since(self, user_auth, name, seq, limit):
+        """Fetch the messages after the last sequence id a client has seen
 
-    def create_room(self, user_auth, name):
+        :return: ([(seq, timestamp, handle, message), ...], has_more) with at
+                 most limit messages, has_more is True if newer ones are left
+        """
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized user')
-        if name in self.rooms:
-            abort(400, message='A room with this name already exists')
-        room = Room(name, {}, {})
-        self.rooms[name] = room
+        if name not in self.rooms:
+            abort(404, message='Room not found')
+        room = self.rooms[name]
+        if self.logged_in_users[user_auth].id not in room.members:
+            abort(401, message='Only members can receive messages')
 
-        with self.conn:
-            db = self.conn.cursor()
-            db.execute("INSERT INTO room (name) VALUES('{}')".format(name))
+        limit = max(1, min(limit, max_fetch_limit))
+        messages = self.history.get_range(room, seq + 1, seq + 1 + limit)
+        last = messages[-1][0] if messages else seq
+        return self._with_handles(messages), last < room.last_seq
 
-    def destroy_room(self, user_auth, name):
+    @synchronized
+    def wait_for_messages(self, user_auth, name, since, timeout, encoded=False):
+        """Wait until the room has messages newer than since, or timeout
+
+        The server lock is released while waiting, so handle_message can
+        append to the room and wake up the waiters.
+
+        :return: ([(seq, timestamp, handle, message), ...], has_more, cursor)
+                 with at most max_fetch_limit messages newer than since, empty
+                 if the timeout expired first, or with encoded the JSON of
+                 each message as self._encode makes it. has_more is True if
+                 newer ones are left, to fetch from the seq cursor on
+        """
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized user')
         if name not in self.rooms:
             abort(404, message='Room not found')
-        del self.rooms[name]
+        room = self.rooms[name]
+        if self.logged_in_users[user_auth].id not in room.members:
+            abort(401, message='Only members can receive messages')
+        # NaN would get past the cap, as min() and every comparison ignore it
+        if math.isnan(timeout) or math.isinf(timeout):
+            abort(400, message='Invalid timeout')
+
+        first = self.history.find_seq(room, self._parse_timestamp(since) + 1)
+        end = first + max_fetch_limit
+        deadline = time.time() + min(timeout, max_wait_seconds)
+        while True:
+            messages = self.history.get_range(room, first, end)
+            remaining = deadline - time.time()
+            if messages or remaining <= 0:
+                cursor = messages[-1][0] if messages else first - 1
+                if encoded:
+                    messages = self.history.get_encoded(room, first, end, self._encode)
+                else:
+                    messages = self._with_handles(messages)
+                return messages, cursor < room.last_seq, cursor
+            room.new_message.wait(remaining)
+            if self.rooms.get(name) is not room:
+                abort(404, message='Room not found')
 
-        with self.conn:
-            db = self.conn.cursor()
-            db.execute("SELECT id FROM room WHERE name = '{}'".format(name))
-            id = db.fetchone()[0]
-            db.execute("DELETE FROM message WHERE room_id = {}".format(id))
-            db.execute("DELETE FROM room WHERE name = '{}'".format(name))
+    @synchronized
+    def subscribe(self, user_auth, names):
+        """Subscribe to the messages of rooms the user is a member of
 
+        :return: a pubsub.Subscription that receives a
+                 (room name, seq, timestamp, handle, message) event per message
+        """
+        user_auth = str(user_auth)
+        if user_auth not in self.logged_in_users:
+            abort(401, message='Unauthorized user')
+        for name in names:
+            if name not in self.rooms:
+                abort(404, message='Room not found')
+            if self.logged_in_users[user_auth].id not in self.rooms[name].members:
+                abort(401, message='Only members can receive messages')
+        # Messages of other processes are only published for known tails
+        for name in names:
+            self.history.load_tail(self.rooms[name])
+        # Indexed by user and session, so the subscription is closed when
+        # either stops being allowed to receive the messages
+        return self.broker.subscribe(names, self.logged_in_users[user_auth].id, user_auth)
+
+    def unsubscribe(self, subscription):
+        self.broker.unsubscribe(subscription)
+
+    @synchronized
+    def create_room(self, user_auth, name):
+        user_auth = str(user_auth)
+        if user_auth not in self.logged_in_users:
+            abort(401, message='Unauthorized user')
+        if name in self.rooms:
+            abort(400, message='A room with this name already exists')
+        try:
+            with self.db:
+                cur = self.db.execute('insert_room', (name,))
+                room = Room(name, {}, self.lock, cur.lastrowid)
+                self._record('room_created', name, room.id)
+        except sqlite3.IntegrityError:
+            # Created by another process, and not seen here yet
+            abort(400, message='A room with this name already exists')
+        # A new room has no history to look up
+        room.last_seq = 0
+        room.last_timestamp = 0
+        self.rooms[name] = room
+        self.events.append('room_created', name)
+        self._journal('room_created', name, room.id)
+
+    @timed
+    def destroy_room(self, user_auth, name):
+        user_auth = str(user_auth)
+        with self.lock:
+            if user_auth not in self.logged_in_users:
+                abort(401, message='Unauthorized user')
+            if name not in self.rooms:
+                abort(404, message='Room not found')
+            room = self.rooms.pop(name)
+            self.memberships.drop_room(room)
+            self.events.append('room_destroyed', name)
+            self.history.drop_room(room)
+            self.broker.drop_room(name)
+            room.new_message.notify_all()
+            self._journal('room_destroyed', name)
+
+        # Deleting the history may take a while, so do it without the lock
+        self.writer.flush()
+        with self.db:
+            self.db.execute('delete_room_messages', (room.id,))
+            self.db.execute('delete_room_memberships', (room.id,))
+            self.db.execute('delete_room', (room.id,))
+            self._record('room_destroyed', name)
+
+    @synchronized
     def join_room(self, user_auth, name):
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized user')
         if name not in self.rooms:
             abort(404, message='Room not found')
-        self.rooms[name].add_member(user_auth, self.logged_in_users[user_auth])
+        user = self.logged_in_users[user_auth]
+        room = self.rooms[name]
+        self.memberships.add(room, user)
+        try:
+            with self.db:
+                self.db.execute('insert_membership', (user.id, room.id))
+                self._record('member_joined', name, user.id)
+        except sqlite3.Error:
+            self.memberships.remove(room, user)
+            raise
+        self.events.append('member_joined', name, user.handle)
+        self._journal('member_joined', name, user.id)
 
+    @synchronized
     def leave_room(self, user_auth, name):
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized user')
         if name not in self.rooms:
             abort(404, message='Room not found')
-        self.rooms[name].remove_member(user_auth)
+        user = self.logged_in_users[user_auth]
+        room = self.rooms[name]
+        self.memberships.remove(room, user)
+        try:
+            with self.db:
+                self.db.execute('delete_membership', (user.id, room.id))
+                self._record('member_left', name, user.id)
+        except sqlite3.Error:
+            self.memberships.add(room, user)
+            raise
+        self.events.append('member_left', name, user.handle)
+        self.broker.close_member(user.id, name)
+        self._journal('member_left', name, user.id)
+
+    @synchronized
+    def sync(self, user_auth, cursors, version=None, limit=100):
+        """Catch up on every joined room in one call
+
+        :param cursors: {room name: last seq seen}, joined rooms that are
+                        missing start from their latest message
+        :param version: the version returned by the previous sync, None the
+                        first time
+        :return: dict(version=<version to pass next time>,
+                      rooms={name: ([(seq, timestamp, handle, message), ...],
+                                    has_more, cursor)} for every joined room,
+                      events=[(version, kind, room, handle), ...]) with the
+                 room and membership changes since version. If they are no
+                 longer known, events is None and the current state is in
+                 room_list=[name, ...] and members={name: [handle, ...]}
+                 for the joined rooms instead.
+        """
+        user_auth = str(user_auth)
+        if user_auth not in self.logged_in_users:
+            abort(401, message='Unauthorized user')
+
+        joined = self.memberships.rooms(self.logged_in_users[user_auth])
+        if shard is not None:
+            index, count = shard
+            joined = [name for name in joined if shard_of(name, count) == index]
+        limit = max(1, min(limit, max_fetch_limit))
+        rooms = {}
+        for name in joined:
+            room = self.rooms[name]
+            self.history.load_tail(room)
+            seq = cursors.get(name, room.last_seq)
+            messages = self.history.get_range(room, seq + 1, seq + 1 + limit)
+            last = messages[-1][0] if messages else seq
+            rooms[name] = self._with_handles(messages), last < room.last_seq, last
+
+        result = dict(version=self.events.version, rooms=rooms)
+        events = None if version is None else self.events.since(version)
+        if events is None:
+            result.update(events=None,
+                          room_list=self.rooms.keys(),
+                          members={name: [m.handle for m in self.rooms[name].members.values()]
+                                   for name in joined})
+        else:
+            result.update(events=events)
+        return result
 
+    @synchronized
     def get_users(self, user_auth):
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized user')
-        result = [u.handle for u in self.logged_in_users.values()]
+        if shared:
+            # Only the sessions this process started or used are in memory
+            with self.db:
+                return [row[0] for row in self.db.query('select_session_handles')]
+        result = [u.handle for u in self.logged_in_users.users()]
         return result
 
+    @synchronized
     def get_rooms(self, user_auth):
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
             abort(401, message='Unauthorized user')
         return self.rooms.keys()
 
+    @synchronized
     def get_room_members(self, user_auth, name):
         user_auth = str(user_auth)
         if user_auth not in self.logged_in_users:
@@ -0,0 +1,71 @@
+class Sessions(object):
+    def __init__(self, multiple, load=None):
+        """Logged in users, indexed both by auth token and by user
+
+        Behaves like a dict of auth token -> User. If multiple is False, a
+        user has at most one session and logging in again replaces it.
+
+        If given, load(user_auth) is called for auth tokens that are not
+        in memory, e.g. sessions started by another process, and returns
+        the User or None. The sessions it finds are kept.
+        """
+        self.multiple = multiple
+        self.load = load
+        # auth token -> User
+        self.by_token = {}
+        # username -> set of auth tokens
+        self.by_user = {}
+
+    def __contains__(self, user_auth):
+        return self.get(user_auth) is not None
+
+    def __getitem__(self, user_auth):
+        user = self.get(user_auth)
+        if user is None:
+            raise KeyError(user_auth)
+        return user
+
+    def __len__(self):
+        return len(self.by_token)
+
+    def get(self, user_auth, default=None):
+        user = self.by_token.get(user_auth)
+        if user is None and self.load is not None:
+            user = self.load(user_auth)
+            if user is not None:
+                self._add(user_auth, user)
+        return default if user is None else user
+
+    def values(self):
+        return self.by_token.values()
+
+    def users(self):
+        """:return: one User per logged in user, however many sessions"""
+        return [self.by_token[next(iter(tokens))] for tokens in self.by_user.itervalues()]
+
+    def tokens(self, user):
+        """:return: the auth tokens of a user's sessions"""
+        return self.by_user.get(user.username, set())
+
+    def add(self, user_auth, user):
+        """Add a session
+
+        :return: the auth tokens of the sessions it replaces
+        """
+        replaced = [] if self.multiple else list(self.tokens(user))
+        for token in replaced:
+            self.remove(token)
+        self._add(user_auth, user)
+        return replaced
+
+    def _add(self, user_auth, user):
+        self.by_token[user_auth] = user
+        self.by_user.setdefault(user.username, set()).add(user_auth)
+
+    def remove(self, user_auth):
+        user = self.by_token.pop(user_auth)
+        tokens = self.by_user[user.username]
+        tokens.discard(user_auth)
+        if not tokens:
+            del self.by_user[user.username]
+        return user
@@ -0,0 +1,166 @@
+import logging
+import marshal
+import mmap
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Length of each journal record
+record_header = struct.Struct('<I')
+
+
+class Snapshots(object):
+    def __init__(self, path):
+        """Snapshots of the in-memory state, and a journal of the changes since
+
+        A snapshot is a marshalled dict, written to a new file and renamed
+        over path, so there is always a complete one. Each snapshot has a
+        generation, and changes made after it is taken go to the journal
+        of that generation, path.<generation>, as length-prefixed
+        marshalled (kind, data) records.
+        """
+        self.path = path
+        self.generation = 0
+        # Changes journaled since the last snapshot was taken
+        self.changes = 0
+        self.journal = None
+        # The generation of the snapshot on disk
+        self.written = -1
+        self.write_lock = threading.Lock()
+
+    def load(self):
+        """:return: (state, [(kind, data), ...] journaled after it), or
+                    (None, []) if there is no snapshot
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return None, []
+        with f:
+            # Read straight from the page cache, without a copy of the file
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    state = marshal.loads(m)
+                finally:
+                    m.close()
+            except (EnvironmentError, EOFError, ValueError, TypeError):
+                logger.exception('Ignoring the unreadable snapshot %s', self.path)
+                return None, []
+        self.generation = self.written = state['generation']
+        changes = []
+        for generation, path in self._journals():
+            if generation >= state['generation']:
+                changes.extend(read_journal(path))
+                self.generation = max(self.generation, generation)
+        return state, changes
+
+    def reset(self):
+        """Remove the snapshot and every journal"""
+        for _, path in self._journals():
+            os.remove(path)
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.generation = 0
+        self.written = -1
+
+    def append(self, kind, *data):
+        record = marshal.dumps((kind, data))
+        self.journal.write(record_header.pack(len(record)) + record)
+        # Written through to the OS, so it survives the process
+        self.journal.flush()
+        self.changes += 1
+
+    def rotate(self):
+        """Start the journal of a new snapshot
+
+        Call it with the state locked, take the state, and write() it once
+        the lock is released.
+
+        :return: the generation of the new snapshot
+        """
+        if self.journal is not None:
+            self.journal.close()
+        self.generation += 1
+        self.journal = open('{}.{}'.format(self.path, self.generation), 'ab')
+        self.changes = 0
+        return self.generation
+
+    def write(self, state, generation):
+        with self.write_lock:
+            # A later snapshot may already be written, with fewer journals
+            if generation <= self.written:
+                return
+            state = dict(state, generation=generation)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                marshal.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_path, self.path)
+            self.written = generation
+            for g, path in self._journals():
+                if g < generation:
+                    os.remove(path)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def _journals(self):
+        """:return: [(generation, path), ...] of the journals on disk, oldest first"""
+        directory, name = os.path.split(os.path.abspath(self.path))
+        journals = []
+        for f in os.listdir(directory):
+            suffix = f[len(name) + 1:]
+            if f.startswith(name + '.') and suffix.isdigit():
+                journals.append((int(suffix), os.path.join(directory, f)))
+        return sorted(journals)
+
+
+def read_journal(path):
+    """:return: the [(kind, data), ...] in a journal, up to the first torn record"""
+    with open(path, 'rb') as f:
+        journal = f.read()
+    changes = []
+    offset = 0
+    while offset + record_header.size <= len(journal):
+        size, = record_header.unpack_from(journal, offset)
+        offset += record_header.size
+        if offset + size > len(journal):
+            break
+        try:
+            changes.append(marshal.loads(journal[offset:offset + size]))
+        except (EOFError, ValueError, TypeError):
+            break
+        offset += size
+    if offset < len(journal):
+        logger.warning('Ignoring the torn end of %s', path)
+    return changes
+
+
+class Snapshotter(threading.Thread):
+    def __init__(self, snapshots, save, interval):
+        """Calls save() every interval seconds, if changes were journaled"""
+        super(Snapshotter, self).__init__(name='Snapshotter')
+        self.daemon = True
+        self.snapshots = snapshots
+        self.save = save
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def close(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            if self.snapshots.changes and not self.stopped.is_set():
+                try:
+                    self.save()
+                except (IOError, OSError):
+                    logger.exception('Failed to save a snapshot')
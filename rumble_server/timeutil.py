@@ -0,0 +1,57 @@
+import datetime
+import re
+
+import dateutil.parser
+import dateutil.tz
+
+epoch = datetime.datetime(1970, 1, 1)
+epoch_ordinal = epoch.toordinal()
+
+# What isoformat() produces for naive datetimes, which is what the server
+# emits, as well as the str() of a datetime older databases hold
+iso_pattern = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?$')
+
+
+def to_micros(timestamp):
+    """Naive UTC datetime -> integer microseconds since the epoch"""
+    delta = timestamp - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_micros(micros):
+    """Integer microseconds since the epoch -> naive UTC datetime"""
+    return epoch + datetime.timedelta(microseconds=micros)
+
+
+def now():
+    return to_micros(datetime.datetime.utcnow())
+
+
+def parse_iso(text):
+    """ISO 8601 timestamp -> integer microseconds since the epoch
+
+    Timestamps in the format the server emits are parsed directly, anything
+    else falls back to dateutil. Timestamps without an offset are UTC.
+    """
+    match = iso_pattern.match(text)
+    if match is None or int(match.group(4)) > 23 or int(match.group(5)) > 59 or int(match.group(6)) > 59:
+        return parse_any(text)
+    year, month, day, hour, minute, second, fraction = match.groups()
+    days = datetime.date(int(year), int(month), int(day)).toordinal() - epoch_ordinal
+    seconds = ((days * 24 + int(hour)) * 60 + int(minute)) * 60 + int(second)
+    micros = int(fraction.ljust(6, '0')) if fraction else 0
+    return seconds * 1000000 + micros
+
+
+def parse_any(text):
+    """Any timestamp dateutil understands -> integer microseconds since the epoch
+    """
+    timestamp = dateutil.parser.parse(text)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+    return to_micros(timestamp)
+
+
+def format_iso(micros):
+    """Integer microseconds since the epoch -> ISO 8601, as isoformat() does"""
+    return from_micros(micros).isoformat()
@@ -1,6 +1,7 @@
 class User(object):
-    def __init__(self, username, password, handle, registered):
+    def __init__(self, username, password, handle, registered, id=None):
         # List of invited members
+        self.id = id
         self.username = username
         self.password = password
         self.handle = handle
@@ -0,0 +1,124 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter(threading.Thread):
+    def __init__(self, db_path, db_stats, flush_interval, max_batch_size, database_class=Database):
+        """Write-behind persistence of messages
+
+        Messages are queued in memory and written on this thread, with its
+        own connection, in one executemany transaction per batch. A message
+        waits at most flush_interval seconds, and a batch holds at most
+        max_batch_size messages, unless messages queued together by
+        put_many are more than that, as they always share a transaction.
+        """
+        super(MessageWriter, self).__init__(name='MessageWriter')
+        self.daemon = True
+        self.db_path = db_path
+        self.db_stats = db_stats
+        self.database_class = database_class
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.cond = threading.Condition()
+        # Lists of (room id, user id, seq, timestamp, message) rows waiting
+        # to be written, each list in the same transaction
+        self.pending = []
+        self.pending_rows = 0
+        self.queued = 0
+        self.written = 0
+        self.flushing = 0
+        self.closing = False
+
+    def put(self, row):
+        self.put_many([row])
+
+    def put_many(self, rows):
+        """Queue rows to be written in the same transaction"""
+        if not rows:
+            return
+        with self.cond:
+            self.pending.append(rows)
+            self.pending_rows += len(rows)
+            self.queued += len(rows)
+            if len(self.pending) == 1 or self.pending_rows >= self.max_batch_size:
+                self.cond.notify_all()
+
+    def flush(self):
+        """Block until every message queued so far is written"""
+        with self.cond:
+            target = self.queued
+            self.flushing += 1
+            self.cond.notify_all()
+            try:
+                while self.written < target and self.is_alive():
+                    self.cond.wait(self.flush_interval)
+            finally:
+                self.flushing -= 1
+
+    def close(self):
+        """Write all queued messages and stop the thread"""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.join()
+
+    def run(self):
+        db = self.database_class(self.db_path, self.db_stats)
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                self._write(db, batch)
+                with self.cond:
+                    self.written += len(batch)
+                    self.cond.notify_all()
+        finally:
+            db.close()
+
+    def _next_batch(self):
+        """Wait until a batch is due and take it, None once closed and drained
+        """
+        with self.cond:
+            while not self.pending and not self.closing:
+                self.cond.wait()
+            deadline = time.time() + self.flush_interval
+            while (not self.closing and
+                   not self.flushing and
+                   self.pending_rows < self.max_batch_size):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            if not self.pending:
+                return None
+            batch = []
+            groups = 0
+            for rows in self.pending:
+                if batch and len(batch) + len(rows) > self.max_batch_size:
+                    break
+                batch.extend(rows)
+                groups += 1
+            del self.pending[:groups]
+            self.pending_rows -= len(batch)
+            return batch
+
+    def _write(self, db, batch):
+        while True:
+            try:
+                with db:
+                    db.executemany('insert_message', batch)
+                return
+            except sqlite3.OperationalError:
+                # Most likely the database is locked, try again
+                logger.exception('Failed to write %d messages, retrying', len(batch))
+                time.sleep(self.flush_interval)
+            except sqlite3.Error:
+                logger.exception('Failed to write %d messages, dropping them', len(batch))
+                return
@@ -1,23 +1,43 @@
 from datetime import datetime, timedelta
+import glob
+import httplib
 import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
 import time
+import itertools
 import json
 from unittest import TestCase
 import uuid
 
-from mock import Mock
+from mock import Mock, patch
 from werkzeug.datastructures import Headers
 
 from rumble_server import server
 from rumble_server.api import create_app
+from rumble_server.cooperative import CooperativeServer, ThreadpoolDatabase
+from rumble_server.db import StatementStats, statements
+from rumble_server.events import EventLog
+from rumble_server.history import Block, History
+from rumble_server.pubsub import Broker
+from rumble_server.ratelimit import RateLimiter
+from rumble_server.room import Room
+from rumble_server.router import Backend, create_router, shard_of
+from rumble_server import timeutil
+from rumble_server.timeutil import parse_iso, to_micros
 from rumble_server.user import User
+from rumble_server.writer import MessageWriter
 
 
 class ServerTest(TestCase):
     def setUp(self):
         db_file = os.path.abspath('rumble.db')
-        if os.path.isfile(db_file):
-            os.remove(db_file)
+        for f in (db_file, db_file + '-wal', db_file + '-shm') + tuple(glob.glob(db_file + '.snapshot*')):
+            if os.path.isfile(f):
+                os.remove(f)
         cmd = 'sqlite3 {} < ../rumble_server/rumble_schema.sql'
         cmd = cmd.format(db_file)
         os.system(cmd)
@@ -25,7 +45,8 @@ class ServerTest(TestCase):
         # Reset singleton every time
         server.instance = None
         app = create_app(db_file)
-        self.conn = server.get_instance().conn
+        server.get_instance()
+        self.conn = sqlite3.connect(db_file)
         self.test_app = app.test_client()
 
         self.bad_auth = Headers()
@@ -33,7 +54,8 @@ class ServerTest(TestCase):
 
 
     def tearDown(self):
-        server.instance.conn.close()
+        self.conn.close()
+        server.instance.disconnect()
 
     def _register_test_user(self, username='Saar_Sayfan', password='passwurd', handle='Saar'):
         post_data = dict(username=username,
@@ -107,6 +129,86 @@ class ServerTest(TestCase):
             expected = [(1, 'Saar_Sayfan', 'passwurd', 'Saar')]
             self.assertEqual(expected, users)
 
+    def test_register_taken_in_database(self):
+        # A user registered by another process isn't in memory, but the
+        # unique index still rejects it
+        with self.conn:
+            self.conn.execute("INSERT INTO user (name, password, handle) VALUES('Saar_Sayfan', 'x', 'Other')")
+
+        response = self._register_test_user()
+        self.assertEqual(400, response.status_code)
+
+    def test_import_users(self):
+        auth = self._login_test_user()
+        admins = patch.object(server, 'user_admins', frozenset(['Saar_Sayfan']))
+        admins.start()
+        self.addCleanup(admins.stop)
+        users = [dict(username='a', password='pa', handle='A'),
+                 dict(username='b', password='pb', handle='Saar'),
+                 dict(username='a', password='pc', handle='C'),
+                 dict(username='d', password='pd'),
+                 dict(username=None, password=None, handle=None),
+                 dict(username={}, password='pf', handle='F'),
+                 dict(username='e', password='pe', handle='E')]
+        response = self.test_app.post('/users',
+                                      data=json.dumps(dict(users=users)),
+                                      content_type='application/json',
+                                      headers=auth)
+        self.assertEqual(200, response.status_code)
+        result = json.loads(response.data)['result']
+        expected = [dict(result='OK'),
+                    dict(message='Handle Saar is already taken'),
+                    dict(message='Username a is already taken'),
+                    dict(message='A username, password and handle are required'),
+                    dict(message='A username, password and handle are required'),
+                    dict(message='A username, password and handle are required'),
+                    dict(result='OK')]
+        self.assertEqual(expected, result)
+
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT * FROM user")
+            users = cur.fetchall()
+            expected = [(1, 'Saar_Sayfan', 'passwurd', 'Saar'),
+                        (2, 'a', 'pa', 'A'),
+                        (3, 'e', 'pe', 'E')]
+            self.assertEqual(expected, users)
+
+        post_data = dict(username='e', password='pe')
+        response = self.test_app.post('/active_user', data=post_data)
+        self.assertEqual(200, response.status_code)
+
+    def test_import_users_unauthorized_user(self):
+        users = [dict(username='a', password='pa', handle='A')]
+        response = self.test_app.post('/users',
+                                      data=json.dumps(dict(users=users)),
+                                      content_type='application/json',
+                                      headers=self.bad_auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_import_users_not_admin(self):
+        auth = self._login_test_user()
+        users = [dict(username='a', password='pa', handle='A')]
+        response = self.test_app.post('/users',
+                                      data=json.dumps(dict(users=users)),
+                                      content_type='application/json',
+                                      headers=auth)
+        self.assertEqual(403, response.status_code)
+        self.assertNotIn('a', server.get_instance().users)
+
+    def test_import_users_too_many(self):
+        auth = self._login_test_user()
+        users = [dict(username=name, password='p', handle=name) for name in ('a', 'b', 'c')]
+        with patch.object(server, 'user_admins', frozenset(['Saar_Sayfan'])), \
+                patch.object(server, 'max_import_users', 2):
+            response = self.test_app.post('/users',
+                                          data=json.dumps(dict(users=users)),
+                                          content_type='application/json',
+                                          headers=auth)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('Too many users, at most 2 per import', json.loads(response.data)['message'])
+        self.assertNotIn('a', server.get_instance().users)
+
     def test_user_login_success(self):
         self._register_test_user()
 
@@ -165,6 +267,35 @@ class ServerTest(TestCase):
         finally:
             uuid.uuid4 = uuid4_orig
 
+    def test_user_login_replaces_session(self):
+        auth = self._login_test_user()
+        auth2 = self._login_test_user()
+
+        response = self.test_app.get('/users', headers=auth)
+        self.assertEqual(401, response.status_code)
+        response = self.test_app.get('/users', headers=auth2)
+        self.assertEqual(200, response.status_code)
+        s = server.get_instance()
+        self.assertEqual(1, len(s.logged_in_users))
+
+    def test_user_login_multiple_sessions(self):
+        s = server.get_instance()
+        s.logged_in_users.multiple = True
+        auth = self._login_test_user()
+        auth2 = self._login_test_user()
+        self.assertEqual(2, len(s.logged_in_users))
+
+        for a in (auth, auth2):
+            response = self.test_app.get('/users', headers=a)
+            self.assertEqual(200, response.status_code)
+            result = json.loads(response.data)['result']
+            self.assertEqual(['Saar'], result)
+
+        response = self.test_app.delete('/active_user', headers=auth)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({auth2['Authorization']},
+                         s.logged_in_users.tokens(s.users['Saar_Sayfan']))
+
     def test_user_logout_success(self):
         self._register_test_user()
         auth = self._login_test_user()
@@ -204,6 +335,19 @@ class ServerTest(TestCase):
             expected = [(1, 'room0')]
             self.assertEqual(expected, rooms)
 
+    def test_create_room_ids(self):
+        auth = self._login_test_user()
+        self._register_test_user('Gigi', 'pass', 'G')
+        s = server.get_instance()
+        self.assertEqual(1, s.users['Saar_Sayfan'].id)
+        self.assertEqual(2, s.users['Gigi'].id)
+
+        for name in ('room0', 'room1'):
+            response = self.test_app.post('/room/' + name, headers=auth)
+            self.assertEqual(200, response.status_code)
+        self.assertEqual(1, s.rooms['room0'].id)
+        self.assertEqual(2, s.rooms['room1'].id)
+
     def test_create_room_already_exists(self):
         auth = self._login_test_user()
 
@@ -227,6 +371,13 @@ class ServerTest(TestCase):
             expected = [(1, 'room0')]
             self.assertEqual(expected, rooms)
 
+        # A room created by another process, that this one hasn't loaded
+        with self.conn:
+            self.conn.execute("INSERT INTO room (name) VALUES ('room1')")
+        response = self.test_app.post('/room/room1', headers=auth)
+        self.assertEqual(400, response.status_code)
+        self.assertNotIn('room1', server.get_instance().rooms)
+
     def test_create_room_unauthorized_user(self):
         response = self.test_app.post('/room/room0', headers=self.bad_auth)
         self.assertEqual(401, response.status_code)
@@ -331,6 +482,43 @@ class ServerTest(TestCase):
         result = json.loads(response.data)['result']
         self.assertEqual(['Saar'], result)
 
+    def test_membership_survives_login_and_restart(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room/room1', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        self.test_app.post('/room_member/room1', headers=auth)
+        self.test_app.delete('/room_member/room1', headers=auth)
+
+        # Logging in again keeps the memberships of the user
+        auth = self._login_test_user()
+        response = self.test_app.post('/message/room0', data=dict(message='hi'), headers=auth)
+        self.assertEqual(200, response.status_code)
+
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT user_id, room_id FROM membership")
+            s = server.get_instance()
+            user_id = s.users['Saar_Sayfan'].id
+            self.assertEqual([(user_id, s.rooms['room0'].id)], cur.fetchall())
+
+        server.instance.disconnect()
+        server.instance = None
+        s = server.get_instance()
+        user = s.users['Saar_Sayfan']
+        self.assertEqual({'room0'}, s.memberships.rooms(user))
+        self.assertEqual({user.id: user}, s.rooms['room0'].members)
+        self.assertEqual({}, s.rooms['room1'].members)
+
+        # Destroying a room removes its memberships
+        auth = self._login_test_user()
+        self.test_app.delete('/room/room0', headers=auth)
+        self.assertEqual(set(), s.memberships.rooms(user))
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT * FROM membership")
+            self.assertEqual([], cur.fetchall())
+
     def test_get_room_members_multiple_members(self):
         auth = self._login_test_user()
         auth2 = self._login_test_user('Guy_Sayfan', 'passwird', 'Guy')
@@ -383,6 +571,8 @@ class ServerTest(TestCase):
                                       headers=auth)
         self.assertEqual(200, response.status_code)
 
+        # Messages are written in the background
+        server.get_instance().writer.flush()
         with self.conn:
             cur = self.conn.cursor()
             cur.execute("SELECT room_id, user_id, message FROM message")
@@ -451,6 +641,8 @@ class ServerTest(TestCase):
                                       headers=auth)
         self.assertEqual(200, response.status_code)
 
+        # Messages are written in the background
+        server.get_instance().writer.flush()
         with self.conn:
             cur = self.conn.cursor()
             cur.execute("SELECT room_id, user_id, message FROM message")
@@ -512,6 +704,83 @@ class ServerTest(TestCase):
             expected = []
             self.assertEqual(expected, messages)
 
+    def test_handle_message_written_on_disconnect(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+
+        for i in range(50):
+            post_data = dict(message='message {}'.format(i))
+            response = self.test_app.post('/message/room0',
+                                          data=post_data,
+                                          headers=auth)
+            self.assertEqual(200, response.status_code)
+
+        # Disconnecting writes every queued message
+        server.instance.disconnect()
+        server.instance = None
+        server.get_instance()
+
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT message FROM message ORDER BY id")
+            messages = [m[0] for m in cur.fetchall()]
+        expected = ['message {}'.format(i) for i in range(50)]
+        self.assertEqual(expected, messages)
+
+    def test_handle_message_with_quotes(self):
+        auth = self._login_test_user('O\'Brien', 'pass\'word', 'O\'B')
+        response = self.test_app.post('/room/Saar\'s room', headers=auth)
+        self.assertEqual(200, response.status_code)
+        self.test_app.post('/room_member/Saar\'s room', headers=auth)
+
+        post_data = dict(message='It\'s "quoted"')
+        response = self.test_app.post('/message/Saar\'s room',
+                                      data=post_data,
+                                      headers=auth)
+        self.assertEqual(200, response.status_code)
+
+        server.get_instance().writer.flush()
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT message FROM message")
+            messages = cur.fetchall()
+            self.assertEqual([('It\'s "quoted"',)], messages)
+
+    def test_db_stats(self):
+        self._login_test_user()
+        s = server.get_instance()
+        stats = s.get_db_stats()
+        calls, seconds = stats['insert_user']
+        self.assertEqual(1, calls)
+        self.assertTrue(seconds >= 0)
+        self.assertEqual(1, stats['select_users'][0])
+
+    def test_handle_message_concurrent(self):
+        s = server.get_instance()
+        self.test_app.post('/room/room0', headers=self._login_test_user())
+        auths = []
+        for i in range(8):
+            auth = self._login_test_user('user{}'.format(i), 'pass', 'handle{}'.format(i))
+            self.test_app.post('/room_member/room0', headers=auth)
+            auths.append(auth['Authorization'])
+
+        def send(user_auth):
+            for i in range(50):
+                s.handle_message(user_auth, 'room0', 'message {}'.format(i))
+
+        threads = [threading.Thread(target=send, args=(a,)) for a in auths]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        s.writer.flush()
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM message")
+            self.assertEqual(400, cur.fetchone()[0])
+
     def test_get_messages_unauthorized_user(self):
         auth = self._login_test_user()
 
@@ -537,6 +806,18 @@ class ServerTest(TestCase):
         response = self.test_app.get('/messages/room0/start/end', headers=auth)
         self.assertEqual(401, response.status_code)
 
+    def test_get_messages_invalid_timestamp(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        for start in ('garbage', '2017-02-30T00:00:00', '99999999999-01-01'):
+            response = self.test_app.get('/messages/room0/{}/2017-01-01T00:00:00'.format(start),
+                                         headers=auth)
+            self.assertEqual(400, response.status_code)
+            self.assertEqual('Invalid timestamp', json.loads(response.data)['message'])
+        response = self.test_app.get('/new_messages/room0/2017-02-30T00:00:00?timeout=0', headers=auth)
+        self.assertEqual(400, response.status_code)
+
     def test_get_messages_no_messages(self):
         auth = self._login_test_user()
 
@@ -624,6 +905,922 @@ class ServerTest(TestCase):
         self.assertEqual('TEST MESSAGE 1', values[1][2])
         self.assertEqual('TEST MESSAGE 2', values[2][2])
 
+    def test_get_messages_same_second(self):
+        auth = self._login_test_user()
+
+        response = self.test_app.post('/room/room0', headers=auth)
+        self.assertEqual(200, response.status_code)
+
+        response = self.test_app.post('/room_member/room0',
+                                      headers=auth)
+        self.assertEqual(200, response.status_code)
+        start = datetime.utcnow().replace(microsecond=0)
+
+        # send 3 messages without waiting, most likely within the same second
+        for i in range(3):
+            post_data = dict(message='TEST MESSAGE {}'.format(i))
+            response = self.test_app.post('/message/room0',
+                                          data=post_data,
+                                          headers=auth)
+            self.assertEqual(200, response.status_code)
+
+        end = start + timedelta(seconds=10)
+        response = self.test_app.get('/messages/room0/{}/{}'.format(start.isoformat(), end.isoformat()), headers=auth)
+        self.assertEqual(200, response.status_code)
+        result = json.loads(response.data)['result']
+        values = [r[2] for r in result]
+        self.assertEqual(['TEST MESSAGE 0', 'TEST MESSAGE 1', 'TEST MESSAGE 2'], values)
+
+    def test_handle_messages(self):
+        auth = self._login_test_user()
+        for name in ('room0', 'room1', 'room2'):
+            self.test_app.post('/room/{}'.format(name), headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        self.test_app.post('/room_member/room1', headers=auth)
+        self.test_app.post('/message/room0', data=dict(message='before'), headers=auth)
+        s = server.get_instance()
+        s.writer.flush()
+        writes = s.get_db_stats()['insert_message'][0]
+
+        messages = [dict(room='room0', message='a'),
+                    dict(room='room1', message='b'),
+                    dict(room='room2', message='c'),
+                    dict(room='room3', message='d'),
+                    dict(room='room0'),
+                    dict(room='room0', message='e')]
+        response = self.test_app.post('/message_batch',
+                                      data=json.dumps(dict(messages=messages)),
+                                      content_type='application/json',
+                                      headers=auth)
+        self.assertEqual(200, response.status_code)
+        expected = [dict(result='OK', seq=2),
+                    dict(result='OK', seq=1),
+                    dict(message='Only members can send messages'),
+                    dict(message='Room not found'),
+                    dict(message='A room and a message are required'),
+                    dict(result='OK', seq=3)]
+        self.assertEqual(expected, json.loads(response.data)['result'])
+
+        s.writer.flush()
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT room_id, seq, message FROM message ORDER BY id")
+            room0, room1 = s.rooms['room0'].id, s.rooms['room1'].id
+            expected = [(room0, 1, 'before'), (room0, 2, 'a'), (room1, 1, 'b'), (room0, 3, 'e')]
+            self.assertEqual(expected, cur.fetchall())
+        # The batch was written in a single transaction
+        self.assertEqual(writes + 1, s.get_db_stats()['insert_message'][0])
+
+    def test_handle_messages_unauthorized_user(self):
+        messages = [dict(room='room0', message='a')]
+        response = self.test_app.post('/message_batch',
+                                      data=json.dumps(dict(messages=messages)),
+                                      content_type='application/json',
+                                      headers=self.bad_auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_handle_messages_too_many(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        s = server.get_instance()
+        messages = [dict(room='room0', message='a')] * 3
+        with patch.object(server, 'max_batch_messages', 2):
+            response = self.test_app.post('/message_batch',
+                                          data=json.dumps(dict(messages=messages)),
+                                          content_type='application/json',
+                                          headers=auth)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('Too many messages, at most 2 per batch', json.loads(response.data)['message'])
+        self.assertEqual(0, s.rooms['room0'].last_seq)
+
+    def test_writer_keeps_batches_together(self):
+        stats = StatementStats()
+        writer = MessageWriter(server.get_db_path(), stats, flush_interval=0.01, max_batch_size=2)
+        writer.start()
+        writer.put_many([(1, 1, seq, seq, 'a') for seq in range(1, 6)])
+        writer.put((1, 1, 6, 6, 'b'))
+        writer.close()
+        self.assertEqual(2, stats.snapshot()['insert_message'][0])
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT seq FROM message ORDER BY id")
+            self.assertEqual(range(1, 7), [r[0] for r in cur.fetchall()])
+
+    def test_messages_json_cache(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        s = server.get_instance()
+        start = datetime.utcnow().isoformat()
+        for i in range(3):
+            post_data = dict(message='TEST MESSAGE {}'.format(i))
+            self.test_app.post('/message/room0', data=post_data, headers=auth)
+        url = '/messages/room0/{}/{}'.format(start, (datetime.utcnow() + timedelta(seconds=1)).isoformat())
+
+        def get():
+            response = self.test_app.get(url, headers=auth)
+            self.assertEqual(200, response.status_code)
+            return [m[2] for m in json.loads(response.data)['result']]
+
+        expected = ['TEST MESSAGE {}'.format(i) for i in range(3)]
+        self.assertEqual(expected, get())
+        self.assertEqual(dict(hits=0, misses=1), s.get_cache_stats())
+        self.assertEqual(expected, get())
+        self.assertEqual(dict(hits=1, misses=1), s.get_cache_stats())
+
+        # A new message is encoded on the next request
+        self.test_app.post('/message/room0', data=dict(message='TEST MESSAGE 3'), headers=auth)
+        self.assertEqual(expected + ['TEST MESSAGE 3'], get())
+        self.assertEqual(dict(hits=1, misses=2), s.get_cache_stats())
+
+        # A room created again after being destroyed starts afresh
+        self.test_app.delete('/room/room0', headers=auth)
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        self.assertEqual([], get())
+        self.test_app.post('/message/room0', data=dict(message='TEST MESSAGE 4'), headers=auth)
+        self.assertEqual(['TEST MESSAGE 4'], get())
+
+    def _sync(self, auth, rooms=None, version=None):
+        data = dict(rooms=rooms or {}, version=version)
+        response = self.test_app.post('/sync',
+                                      data=json.dumps(data),
+                                      content_type='application/json',
+                                      headers=auth)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.data)
+
+    def test_sync(self):
+        auth = self._login_test_user()
+        other_auth = self._login_test_user('other', 'pass', 'Other')
+        for name in ('room0', 'room1', 'room2'):
+            self.test_app.post('/room/{}'.format(name), headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        self.test_app.post('/room_member/room1', headers=auth)
+        self.test_app.post('/message/room0', data=dict(message='old'), headers=auth)
+
+        # The first sync has the current state, and rooms start at their end
+        data = self._sync(auth)
+        self.assertIsNone(data['events'])
+        self.assertEqual(['room0', 'room1', 'room2'], sorted(data['room_list']))
+        self.assertEqual(dict(room0=['Saar'], room1=['Saar']), data['members'])
+        self.assertEqual(dict(room0=dict(result=[], has_more=False, cursor=1),
+                              room1=dict(result=[], has_more=False, cursor=0)),
+                         data['rooms'])
+        version = data['version']
+
+        self.test_app.post('/room_member/room0', headers=other_auth)
+        self.test_app.post('/message/room0', data=dict(message='new'), headers=other_auth)
+        self.test_app.post('/message/room1', data=dict(message='a'), headers=auth)
+        self.test_app.post('/message/room1', data=dict(message='b'), headers=auth)
+        self.test_app.delete('/room/room2', headers=auth)
+        self.test_app.post('/room/room3', headers=auth)
+        self.test_app.delete('/room_member/room1', headers=auth)
+
+        data = self._sync(auth, dict(room0=1), version)
+        self.assertEqual(['room0'], data['rooms'].keys())
+        room0 = data['rooms']['room0']
+        self.assertEqual([(2, 'Other', 'new')], [(m[0], m[2], m[3]) for m in room0['result']])
+        self.assertEqual(2, room0['cursor'])
+        events = [(e['type'], e['room'], e['handle']) for e in data['events']]
+        self.assertEqual([('member_joined', 'room0', 'Other'),
+                          ('room_destroyed', 'room2', None),
+                          ('room_created', 'room3', None),
+                          ('member_left', 'room1', 'Saar')], events)
+        self.assertEqual(data['version'], data['events'][-1]['version'])
+
+        data = self._sync(auth, dict(room0=2), data['version'])
+        self.assertEqual([], data['events'])
+        self.assertEqual(dict(room0=dict(result=[], has_more=False, cursor=2)), data['rooms'])
+
+    def test_event_log_since(self):
+        log = EventLog(max_events=2)
+        self.assertEqual([], log.since(0))
+        for name in ('a', 'b', 'c'):
+            log.append('room_created', name)
+        self.assertEqual([(3, 'room_created', 'c', None)], log.since(2))
+        self.assertEqual(2, len(log.since(1)))
+        self.assertEqual([], log.since(3))
+        # Dropped events, or versions from before a restart
+        self.assertIsNone(log.since(0))
+        self.assertIsNone(log.since(4))
+
+    def test_sync_unauthorized_user(self):
+        response = self.test_app.post('/sync',
+                                      data=json.dumps(dict(rooms={})),
+                                      content_type='application/json',
+                                      headers=self.bad_auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_shared_workers(self):
+        # Two servers on the same database, as two worker processes
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        server.instance.disconnect()
+        with patch.object(server, 'shared', True):
+            server.instance = None
+            a = server.get_instance()
+            b = server.Server()
+            try:
+                # Users and sessions of one worker are found by the other
+                a.register('Guy_Sayfan', 'passwird', 'Guy')
+                guy_auth = b.login('Guy_Sayfan', 'passwird')
+                a.join_room(guy_auth, 'room0')
+                saar_auth = a.login('Saar_Sayfan', 'passwurd')
+                self.assertIn(saar_auth, b.logged_in_users)
+
+                # Seqs are taken from the database, so they don't collide
+                a.handle_message(saar_auth, 'room0', 'a1')
+                b.handle_message(saar_auth, 'room0', 'b2')
+                a.handle_message(guy_auth, 'room0', 'a3')
+                expected = [(1, 'Saar', 'a1'), (2, 'Saar', 'b2'), (3, 'Guy', 'a3')]
+                result = a.get_messages_since(saar_auth, 'room0', 0, 10)[0]
+                self.assertEqual(expected, [(m[0], m[2], m[3]) for m in result])
+                timestamps = [m[1] for m in result]
+                self.assertEqual(sorted(set(timestamps)), timestamps)
+
+                # Every worker knows who is logged in, wherever they did
+                a.register('Gigi', 'pass', 'G')
+                a.login('Gigi', 'pass')
+                self.assertEqual(['G', 'Guy', 'Saar'], sorted(a.get_users(guy_auth)))
+                self.assertEqual(['G', 'Guy', 'Saar'], sorted(b.get_users(guy_auth)))
+
+                # Logging in again ends the sessions in every worker
+                b.login('Saar_Sayfan', 'passwurd')
+                a.disconnect()
+                server.instance = None
+                c = server.get_instance()
+                self.assertNotIn(saar_auth, c.logged_in_users)
+            finally:
+                b.disconnect()
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'Timed out')
+            time.sleep(0.01)
+
+    def test_shared_change_feed(self):
+        server.instance.disconnect()
+        with patch.object(server, 'shared', True), patch.object(server, 'feed_interval', 0.01):
+            server.instance = None
+            a = server.get_instance()
+            b = server.Server()
+            try:
+                a.register('Saar_Sayfan', 'passwurd', 'Saar')
+                a_auth = a.login('Saar_Sayfan', 'passwurd')
+                b.register('Guy_Sayfan', 'passwird', 'Guy')
+                b_auth = b.login('Guy_Sayfan', 'passwird')
+
+                # Rooms and memberships
+                a.create_room(a_auth, 'room0')
+                self._wait_for(lambda: 'room0' in b.rooms)
+                a.join_room(a_auth, 'room0')
+                b.join_room(b_auth, 'room0')
+                self._wait_for(lambda: len(a.rooms['room0'].members) == 2)
+                self._wait_for(lambda: len(b.rooms['room0'].members) == 2)
+
+                # Messages wake up the waiters and subscribers of other processes
+                subscription = b.subscribe(b_auth, ['room0'])
+                result = []
+                since = datetime.utcnow().isoformat()
+                waiter = threading.Thread(
+                    target=lambda: result.extend(b.wait_for_messages(b_auth, 'room0', since, 5)[0]))
+                waiter.start()
+                a.handle_message(a_auth, 'room0', 'hello')
+                waiter.join()
+                self.assertEqual([(1, 'Saar', 'hello')], [(m[0], m[2], m[3]) for m in result])
+                events = subscription.get(5)
+                self.assertEqual([('room0', 1, 'Saar', 'hello')], [(e[0], e[1], e[3], e[4]) for e in events])
+
+                b.handle_message(b_auth, 'room0', 'hi')
+                self._wait_for(lambda: a.rooms['room0'].last_seq == 2)
+                result = a.get_messages_since(a_auth, 'room0', 0, 10)[0]
+                self.assertEqual(['hello', 'hi'], [m[3] for m in result])
+
+                # Sessions that end in one process end in the others
+                a.logout(a_auth)
+                self._wait_for(lambda: a_auth not in b.logged_in_users.by_token)
+                self.assertNotIn(a_auth, b.logged_in_users)
+
+                b.leave_room(b_auth, 'room0')
+                self._wait_for(lambda: len(a.rooms['room0'].members) == 1)
+                b.destroy_room(b_auth, 'room0')
+                self._wait_for(lambda: 'room0' not in a.rooms)
+            finally:
+                b.disconnect()
+
+    def _restart(self):
+        server.instance.disconnect()
+        server.instance = None
+        return server.get_instance()
+
+    def test_snapshot_restart(self):
+        auth = self._login_test_user()
+        other_auth = self._login_test_user('other', 'pass', 'Other')
+        for name in ('room0', 'room1'):
+            self.test_app.post('/room/' + name, headers=auth)
+            self.test_app.post('/room_member/' + name, headers=auth)
+        self.test_app.post('/room_member/room0', headers=other_auth)
+        self.test_app.delete('/room_member/room1', headers=auth)
+        self.test_app.post('/message/room0', data=dict(message='hi'), headers=auth)
+        version = self._sync(auth)['version']
+
+        # Restarts from the snapshot, rather than from the database
+        with patch.object(server.Server, '_load_all_users', side_effect=AssertionError):
+            s = self._restart()
+        self.assertEqual(['Other', 'Saar'], sorted(s.users_by_handle))
+        self.assertEqual(['Other', 'Saar'], sorted(u.handle for u in s.rooms['room0'].members.values()))
+        self.assertEqual({}, s.rooms['room1'].members)
+        # Clients stay logged in, and keep syncing from where they were
+        data = self._sync(auth, dict(room0=0), version)
+        self.assertEqual([], data['events'])
+        self.assertEqual(['hi'], [m[3] for m in data['rooms']['room0']['result']])
+
+        # Changes since the snapshot are replayed from the journal, up to a torn record
+        self.test_app.delete('/active_user', headers=other_auth)
+        self.test_app.post('/room/room2', headers=auth)
+        self.test_app.post('/room_member/room2', headers=auth)
+        self._register_test_user('third', 'pass', 'Third')
+        journal = '{}.{}'.format(s.snapshots.path, s.snapshots.generation)
+        with open(journal, 'ab') as f:
+            f.write('\xff\xff')
+        # As if the process died, without taking a last snapshot
+        s.snapshots.changes = 0
+        s = self._restart()
+        self.assertEqual(['Saar'], [u.handle for u in s.logged_in_users.values()])
+        self.assertEqual(['Saar'], [u.handle for u in s.rooms['room2'].members.values()])
+        self.assertIn('Third', s.users_by_handle)
+
+        # A snapshot that doesn't know of every user or room isn't used
+        s.disconnect()
+        with self.conn:
+            self.conn.execute("INSERT INTO user (name, password, handle) VALUES ('fourth', 'pass', 'Fourth')")
+        server.instance = None
+        s = server.get_instance()
+        self.assertIn('Fourth', s.users_by_handle)
+        self.assertEqual(0, len(s.logged_in_users))
+
+    def test_cooperative_server(self):
+        # gevent's pool of threads, without gevent
+        threads = set()
+
+        def run(function, *args):
+            result = []
+            error = []
+
+            def target():
+                threads.add(threading.current_thread())
+                try:
+                    result.append(function(*args))
+                except Exception as e:
+                    error.append(e)
+
+            t = threading.Thread(target=target)
+            t.start()
+            t.join()
+            if error:
+                raise error[0]
+            return result[0]
+
+        server.instance.disconnect()
+        with patch.object(ThreadpoolDatabase, 'run', staticmethod(run)):
+            server.instance = CooperativeServer()
+            auth = self._login_test_user()
+            self.test_app.post('/room/room0', headers=auth)
+            self.test_app.post('/room_member/room0', headers=auth)
+            self.test_app.post('/message/room0', data=dict(message='hi'), headers=auth)
+            server.instance.writer.flush()
+            # Read it back from the database
+            server.instance.history.drop_room(server.instance.rooms['room0'])
+            server.instance.rooms['room0'].last_seq = None
+            response = self.test_app.get('/messages_since/room0/0', headers=auth)
+            self.assertEqual(['hi'], [m[3] for m in json.loads(response.data)['result']])
+        # Every statement ran on another thread
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertNotIn(server.instance.writer, threads)
+
+    def test_shard_of(self):
+        # Stable across processes and runs, unlike hash()
+        self.assertEqual(shard_of('room0', 4), shard_of(u'room0', 4))
+        self.assertEqual(1, shard_of('room0', 4))
+        counts = [0] * 4
+        for i in range(1000):
+            counts[shard_of('room{}'.format(i), 4)] += 1
+        self.assertTrue(all(c > 200 for c in counts), counts)
+
+    def test_backend_retries(self):
+        def response(fails):
+            r = Mock(status=200)
+            r.getheaders.return_value = []
+            r.read.side_effect = [IOError()] if fails else ['OK']
+            return r
+
+        def backend(*connections):
+            b = Backend('127.0.0.1:1')
+            b.local.conn = connections[0]
+            return b, patch('rumble_server.router.httplib.HTTPConnection', side_effect=connections[1:])
+
+        # A kept-alive connection closed by the backend, before any response
+        stale = Mock()
+        stale.getresponse.side_effect = httplib.BadStatusLine("''")
+        fresh = Mock()
+        fresh.getresponse.return_value = response(False)
+        b, connect = backend(stale, fresh)
+        with connect:
+            self.assertEqual((200, [], 'OK'), b.request('POST', '/message/room0', {}, 'm'))
+        fresh.request.assert_called_once_with('POST', '/message/room0', 'm', {})
+
+        # The POST may have been carried out
+        conn = Mock()
+        conn.getresponse.return_value = response(True)
+        b, connect = backend(conn, Mock())
+        with connect:
+            self.assertRaises(IOError, b.request, 'POST', '/message/room0', {}, 'm')
+        # A fresh connection isn't stale
+        conn = Mock()
+        conn.request.side_effect = IOError()
+        b, connect = backend(None, conn, Mock())
+        with connect:
+            self.assertRaises(IOError, b.request, 'DELETE', '/room/room0', {})
+        self.assertEqual(1, conn.request.call_count)
+
+        # A GET changes nothing, so it is sent again
+        conn = Mock()
+        conn.getresponse.return_value = response(True)
+        fresh = Mock()
+        fresh.getresponse.return_value = response(False)
+        b, connect = backend(conn, fresh)
+        with connect:
+            self.assertEqual((200, [], 'OK'), b.request('GET', '/rooms', {}))
+
+    def test_router(self):
+        from werkzeug.serving import make_server
+        # So the shards soon notice closed streams
+        heartbeat = patch.object(server, 'stream_heartbeat_seconds', 0.01)
+        heartbeat.start()
+        self.addCleanup(heartbeat.stop)
+        http_server = make_server('127.0.0.1', 0, self.test_app.application, threaded=True)
+        threading.Thread(target=http_server.serve_forever).start()
+        try:
+            # The same server twice, as two shards
+            address = '127.0.0.1:{}'.format(http_server.server_port)
+            router = create_router([address, address]).test_client()
+            names = ['room3', 'room1']
+            self.assertEqual([0, 1], [shard_of(name, 2) for name in names])
+
+            response = router.post('/user', data=dict(username='Saar_Sayfan',
+                                                       password='passwurd',
+                                                       handle='Saar'))
+            self.assertEqual(200, response.status_code)
+            response = router.post('/active_user', data=dict(username='Saar_Sayfan',
+                                                              password='passwurd'))
+            auth = Headers()
+            auth['Authorization'] = json.loads(response.data)['user_auth']
+            for name in names:
+                router.post('/room/' + name, headers=auth)
+                router.post('/room_member/' + name, headers=auth)
+            self.assertEqual(401, router.get('/rooms', headers=self.bad_auth).status_code)
+
+            stream = router.get('/stream?room=room1&room=room3', headers=auth, buffered=False)
+            self.assertEqual(200, stream.status_code)
+
+            # Batches are split between the shards, and the results put back in order
+            messages = [dict(room='room1', message='a'),
+                        dict(room='room3', message='b'),
+                        dict(room='nowhere', message='c'),
+                        dict(room='room1', message='d')]
+            response = router.post('/message_batch', data=json.dumps(dict(messages=messages)),
+                                   content_type='application/json', headers=auth)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual([dict(result='OK', seq=1),
+                              dict(result='OK', seq=1),
+                              dict(message='Room not found'),
+                              dict(result='OK', seq=2)],
+                             json.loads(response.data)['result'])
+
+            # Streams are merged
+            events = [json.loads(e[len('data: '):]) for e in
+                      itertools.islice((e for e in stream.response if not e.startswith(':')), 3)]
+            self.assertEqual([('room1', 'a'), ('room1', 'd'), ('room3', 'b')],
+                             sorted((e['room'], e['message']) for e in events))
+            stream.close()
+            # The shards stop streaming once they notice
+            self._wait_for(lambda: not server.get_instance().broker.subscribers)
+
+            response = router.post('/sync', data=json.dumps(dict(rooms=dict(room1=1))),
+                                   content_type='application/json', headers=auth)
+            data = json.loads(response.data)
+            self.assertEqual(dict(room1=['d'], room3=[]),
+                             {name: [m[3] for m in room['result']]
+                              for name, room in data['rooms'].iteritems()})
+            self.assertEqual(['room1', 'room3'], sorted(data['room_list']))
+
+            response = router.get('/messages_since/room1/0', headers=auth)
+            self.assertEqual(['a', 'd'], [m[3] for m in json.loads(response.data)['result']])
+        finally:
+            http_server.shutdown()
+
+    def _start_shard(self, index, count):
+        """Serve the test database as a shard, in a process of its own
+
+        :return: its address
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        api = os.path.join(os.path.dirname(os.path.abspath(server.__file__)), 'api.py')
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        process = subprocess.Popen([sys.executable, api, '--shard', '{}/{}'.format(index, count),
+                                    '--port', str(port), '--db-path', os.path.abspath('rumble.db')],
+                                   stdout=devnull, stderr=devnull)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        address = '127.0.0.1:{}'.format(port)
+
+        def started():
+            try:
+                Backend(address).request('GET', '/rooms', {})
+                return True
+            except (httplib.HTTPException, IOError):
+                self.assertIsNone(process.poll(), 'The shard exited')
+                return False
+        self._wait_for(started, timeout=30)
+        return address
+
+    def test_router_shards(self):
+        addresses = [self._start_shard(index, 2) for index in range(2)]
+        router = create_router(addresses).test_client()
+        names = ['room3', 'room1']
+        self.assertEqual([0, 1], [shard_of(name, 2) for name in names])
+
+        auths = []
+        for username, handle in (('Saar_Sayfan', 'Saar'), ('Gigi', 'G')):
+            router.post('/user', data=dict(username=username, password='pass', handle=handle))
+            response = router.post('/active_user', data=dict(username=username, password='pass'))
+            self.assertEqual(200, response.status_code)
+            auth = Headers()
+            auth['Authorization'] = json.loads(response.data)['user_auth']
+            auths.append(auth)
+        auth = auths[0]
+        for name in names:
+            self.assertEqual(200, router.post('/room/' + name, headers=auth).status_code)
+            self.assertEqual(200, router.post('/room_member/' + name, headers=auth).status_code)
+
+        # Global routes go to either shard, and both give the same answer
+        def answers(path):
+            return [sorted(json.loads(router.get(path, headers=auth).data)['result']) for _ in addresses]
+        self._wait_for(lambda: answers('/rooms') == [sorted(names)] * 2)
+        self.assertEqual([['G', 'Saar']] * 2, answers('/users'))
+
+        messages = [dict(room='room1', message='a'), dict(room='room3', message='b')]
+        response = router.post('/message_batch', data=json.dumps(dict(messages=messages)),
+                               content_type='application/json', headers=auth)
+        self.assertEqual([dict(result='OK', seq=1)] * 2, json.loads(response.data)['result'])
+
+        # Each shard knows every membership, but only syncs its own rooms
+        headers = {'Authorization': auth['Authorization'], 'Content-Type': 'application/json'}
+        for index, address in enumerate(addresses):
+            backend = Backend(address)
+            other = names[1 - index]
+            self._wait_for(lambda: json.loads(backend.request('GET', '/room_members/' + other,
+                                                              headers)[2])['result'] == ['Saar'])
+            status, _, body = backend.request('POST', '/sync', headers, json.dumps({}))
+            self.assertEqual(200, status)
+            self.assertEqual([names[index]], json.loads(body)['rooms'].keys())
+
+        # The router gathers the rooms of both
+        response = router.post('/sync', data=json.dumps(dict(rooms=dict(room1=0, room3=0))),
+                               content_type='application/json', headers=auth)
+        data = json.loads(response.data)
+        self.assertEqual(dict(room1=['a'], room3=['b']),
+                         {name: [m[3] for m in room['result']]
+                          for name, room in data['rooms'].iteritems()})
+
+    def test_shared_sync_versions(self):
+        server.instance.disconnect()
+        with patch.object(server, 'shared', True), patch.object(server, 'feed_interval', 0.01):
+            server.instance = None
+            a = server.get_instance()
+            b = server.Server()
+            try:
+                a.register('Saar_Sayfan', 'passwurd', 'Saar')
+                auth = a.login('Saar_Sayfan', 'passwurd')
+                for name in ('room0', 'room1'):
+                    b.create_room(auth, name)
+                version = b.sync(auth, {})['version']
+                b.join_room(auth, 'room0')
+                b.join_room(auth, 'room1')
+                self._wait_for(lambda: len(a.memberships.rooms(a.users['Saar_Sayfan'])) == 2)
+
+                # A version from another process gets the full state
+                data = a.sync(auth, {}, version)
+                self.assertIsNone(data['events'])
+                self.assertEqual(['room0', 'room1'], sorted(data['members']))
+                self.assertEqual(2, len(b.sync(auth, {}, version)['events']))
+
+                # Only process starts take an epoch, however many changes were made
+                with self.conn:
+                    self.conn.execute("UPDATE sqlite_sequence SET seq = 3000000 WHERE name = 'change'")
+                c = server.Server()
+                try:
+                    self.assertLess(c.sync(auth, {})['version'], 2 ** 53)
+                finally:
+                    c.disconnect()
+            finally:
+                b.disconnect()
+
+    def test_metrics(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        self.test_app.post('/message/room0', data=dict(message='TEST MESSAGE'), headers=auth)
+        self.test_app.get('/rooms', headers=self.bad_auth)
+
+        response = self.test_app.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = response.data.splitlines()
+        samples = dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+
+        self.assertEqual('1', samples['rumble_request_duration_seconds_count{route="message"}'])
+        self.assertEqual('1', samples['rumble_request_duration_seconds_bucket{le="+Inf",route="message"}'])
+        self.assertEqual('1', samples['rumble_requests_total{route="rooms",status="401"}'])
+        self.assertEqual('1', samples['rumble_server_calls_total{method="handle_message"}'])
+        self.assertIn('rumble_sqlite_seconds_total{statement="insert_user"}', samples)
+        self.assertEqual('1', samples['rumble_rooms'])
+        self.assertEqual('1', samples['rumble_sessions'])
+        self.assertEqual('1', samples['rumble_room_resident_messages{room="room0"}'])
+        self.assertTrue(int(samples['rumble_history_bytes']) > 0)
+        self.assertIn('# TYPE rumble_request_duration_seconds histogram', lines)
+
+    def test_rate_limit(self):
+        with patch.object(server, 'token_rate_limits', dict(Message=(1, 2))):
+            self.test_app = create_app(None).test_client()
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+
+        for i in range(2):
+            response = self.test_app.post('/message/room0', data=dict(message='hi'), headers=auth)
+            self.assertEqual(200, response.status_code)
+        response = self.test_app.post('/message/room0', data=dict(message='hi'), headers=auth)
+        self.assertEqual(429, response.status_code)
+        self.assertEqual('1', response.headers['Retry-After'])
+
+        # Other clients and other resources have buckets of their own
+        other_auth = self._login_test_user('other', 'pass', 'Other')
+        self.test_app.post('/room_member/room0', headers=other_auth)
+        response = self.test_app.post('/message/room0', data=dict(message='hi'), headers=other_auth)
+        self.assertEqual(200, response.status_code)
+        response = self.test_app.get('/rooms', headers=auth)
+        self.assertEqual(200, response.status_code)
+
+    def test_rate_limiter_evicts_least_recently_used(self):
+        limiter = RateLimiter(dict(Message=(0.001, 1)), max_buckets=2)
+        self.assertEqual(0, limiter.acquire('Message', 'a'))
+        self.assertEqual(0, limiter.acquire('Message', 'b'))
+        self.assertGreater(limiter.acquire('Message', 'a'), 0)
+        # b is dropped for c, a is still empty
+        self.assertEqual(0, limiter.acquire('Message', 'c'))
+        self.assertEqual([('Message', 'a'), ('Message', 'c')], list(limiter.buckets))
+        self.assertGreater(limiter.acquire('Message', 'a'), 0)
+
+    def test_concurrency_limit(self):
+        with patch.object(server, 'max_concurrent_requests', 0):
+            self.test_app = create_app(None).test_client()
+        response = self.test_app.get('/rooms', headers=self.bad_auth)
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('1', response.headers['Retry-After'])
+        # Long polls are not counted
+        response = self.test_app.get('/new_messages/room0/2017-01-01?timeout=0', headers=self.bad_auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_get_messages_since(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+
+        response = self.test_app.get('/messages_since/room0/0', headers=auth)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual(dict(result=[], has_more=False, cursor=0), data)
+
+        for i in range(5):
+            post_data = dict(message='TEST MESSAGE {}'.format(i))
+            self.test_app.post('/message/room0', data=post_data, headers=auth)
+
+        response = self.test_app.get('/messages_since/room0/0?limit=3', headers=auth)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual([1, 2, 3], [r[0] for r in data['result']])
+        self.assertEqual('Saar', data['result'][0][2])
+        self.assertEqual('TEST MESSAGE 0', data['result'][0][3])
+        self.assertTrue(data['has_more'])
+        self.assertEqual(3, data['cursor'])
+
+        response = self.test_app.get('/messages_since/room0/3?limit=3', headers=auth)
+        data = json.loads(response.data)
+        self.assertEqual([4, 5], [r[0] for r in data['result']])
+        self.assertFalse(data['has_more'])
+        self.assertEqual(5, data['cursor'])
+
+    def test_get_messages_since_not_member(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+
+        response = self.test_app.get('/messages_since/room0/0', headers=auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_wait_for_messages_timeout(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+
+        since = datetime.utcnow().isoformat()
+        response = self.test_app.get('/new_messages/room0/{}?timeout=0.2'.format(since), headers=auth)
+        self.assertEqual(200, response.status_code)
+        result = json.loads(response.data)['result']
+        self.assertEqual([], result)
+
+    def test_wait_for_messages_invalid_timeout(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        for timeout in ('nan', 'inf'):
+            response = self.test_app.get('/new_messages/room0/2020-01-01T00:00:00?timeout=' + timeout,
+                                         headers=auth)
+            self.assertEqual(400, response.status_code)
+
+    def test_wait_for_messages_already_sent(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        since = (datetime.utcnow() - timedelta(seconds=5)).isoformat()
+
+        post_data = dict(message='TEST MESSAGE')
+        response = self.test_app.post('/message/room0', data=post_data, headers=auth)
+        self.assertEqual(200, response.status_code)
+
+        response = self.test_app.get('/new_messages/room0/{}?timeout=10'.format(since), headers=auth)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual(['TEST MESSAGE'], [r[2] for r in data['result']])
+        self.assertEqual((False, 1), (data['has_more'], data['cursor']))
+
+    def test_wait_for_messages_limit(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        for i in range(3):
+            self.test_app.post('/message/room0', data=dict(message=str(i)), headers=auth)
+
+        with patch.object(server, 'max_fetch_limit', 2):
+            response = self.test_app.get('/new_messages/room0/1970-01-01T00:00:00?timeout=0', headers=auth)
+        data = json.loads(response.data)
+        self.assertEqual(['0', '1'], [r[2] for r in data['result']])
+        self.assertEqual((True, 2), (data['has_more'], data['cursor']))
+        response = self.test_app.get('/messages_since/room0/2', headers=auth)
+        self.assertEqual(['2'], [r[3] for r in json.loads(response.data)['result']])
+
+    def test_wait_for_messages_woken_by_new_message(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        since = (datetime.utcnow() - timedelta(seconds=5)).isoformat()
+
+        s = server.get_instance()
+        sender = threading.Timer(0.3, s.handle_message,
+                                 (auth['Authorization'], 'room0', 'TEST MESSAGE'))
+        sender.start()
+        start = time.time()
+        response = self.test_app.get('/new_messages/room0/{}?timeout=10'.format(since), headers=auth)
+        sender.join()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(time.time() - start < 5)
+        result = json.loads(response.data)['result']
+        self.assertEqual(['TEST MESSAGE'], [r[2] for r in result])
+
+    def test_wait_for_messages_not_member(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+
+        since = datetime.utcnow().isoformat()
+        response = self.test_app.get('/new_messages/room0/{}?timeout=0.2'.format(since), headers=auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_stream_success(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+
+        response = self.test_app.get('/stream?room=room0', headers=auth, buffered=False)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/event-stream', response.mimetype)
+
+        post_data = dict(message='TEST MESSAGE')
+        self.test_app.post('/message/room0', data=post_data, headers=auth)
+
+        s = server.get_instance()
+        # Skip keep-alive comments
+        event = next(e for e in response.response if not e.startswith(':'))
+        self.assertTrue(event.startswith('data: '))
+        data = json.loads(event[len('data: '):])
+        self.assertEqual('room0', data['room'])
+        self.assertEqual('Saar', data['handle'])
+        self.assertEqual('TEST MESSAGE', data['message'])
+
+        response.close()
+        self.assertEqual({}, s.broker.subscribers)
+
+    def test_stream_not_member(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+
+        response = self.test_app.get('/stream?room=room0', headers=auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_stream_slow_subscriber_dropped(self):
+        broker = Broker(max_pending=2)
+        slow = broker.subscribe(['room0'])
+        fast = broker.subscribe(['room0'])
+        for i in range(3):
+            broker.publish('room0', i)
+            self.assertEqual([i], fast.get(0))
+
+        self.assertTrue(slow.overflowed)
+        self.assertEqual([0, 1], slow.get(0))
+        self.assertEqual({fast}, broker.subscribers['room0'])
+
+    def _open_stream(self, auth):
+        for name in ('room0', 'room1'):
+            self.test_app.post('/room/' + name, headers=auth)
+            self.test_app.post('/room_member/' + name, headers=auth)
+        response = self.test_app.get('/stream?room=room0&room=room1', headers=auth, buffered=False)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(server.get_instance().broker.subscribers)
+        return response
+
+    def _assert_stream_closed(self, response, reason):
+        # Closed right away, so reading the stream to its end doesn't block
+        s = server.get_instance()
+        self.assertEqual({}, s.broker.subscribers)
+        self.assertEqual({}, s.broker.by_user)
+        events = [e for e in response.response if not e.startswith(':')]
+        self.assertEqual(['event: closed\ndata: {}\n\n'.format(json.dumps(dict(reason=reason)))],
+                         events)
+
+    def test_stream_closed_on_leave_room(self):
+        auth = self._login_test_user()
+        other_auth = self._login_test_user('Gigi', 'pass', 'G')
+        response = self._open_stream(auth)
+        self.test_app.post('/room_member/room1', headers=other_auth)
+        self.test_app.delete('/room_member/room1', headers=auth)
+        # Sent once the user left, it doesn't reach the user
+        self.test_app.post('/message/room1', data=dict(message='hi'), headers=other_auth)
+        self._assert_stream_closed(response, 'member_left')
+
+    def test_stream_closed_on_logout(self):
+        auth = self._login_test_user()
+        response = self._open_stream(auth)
+        self.test_app.delete('/active_user', headers=auth)
+        self._assert_stream_closed(response, 'session_ended')
+
+    def test_stream_closed_on_new_session(self):
+        auth = self._login_test_user()
+        response = self._open_stream(auth)
+        self._login_test_user()
+        self._assert_stream_closed(response, 'session_ended')
+
+    def test_stream_closed_on_destroy_room(self):
+        auth = self._login_test_user()
+        response = self._open_stream(auth)
+        self.test_app.delete('/room/room0', headers=auth)
+        self._assert_stream_closed(response, 'room_destroyed')
+
+    def test_stream_sends_pending_messages_before_closing(self):
+        auth = self._login_test_user()
+        response = self._open_stream(auth)
+        self.test_app.post('/message/room1', data=dict(message='before'), headers=auth)
+        self.test_app.delete('/room_member/room1', headers=auth)
+        events = [e for e in response.response if not e.startswith(':')]
+        self.assertEqual(2, len(events))
+        self.assertEqual('before', json.loads(events[0][len('data: '):])['message'])
+        self.assertTrue(events[1].startswith('event: closed'))
+
+    def test_stream_closed_by_other_process(self):
+        auth = self._login_test_user()
+        s = server.get_instance()
+        response = self._open_stream(auth)
+        # As the change feed applies another process' logout
+        s.apply_changes([('session_ended', (auth['Authorization'],))])
+        self._assert_stream_closed(response, 'session_ended')
+
     def test_get_users_unauthorized_user(self):
         auth = None
 
@@ -653,6 +1850,7 @@ class ServerTest(TestCase):
     def test_server_init(self):
         s = server.get_instance()
         auth = self._login_test_user()
+        start = datetime.utcnow() - timedelta(seconds=1)
 
         for name in ('room0', 'room1'):
             response = self.test_app.post('/room/' + name, headers=auth)
@@ -676,6 +1874,8 @@ class ServerTest(TestCase):
                                           headers=auth)
             self.assertEqual(200, response.status_code)
 
+        # Messages are written in the background
+        server.get_instance().writer.flush()
         with self.conn:
             cur = self.conn.cursor()
             cur.execute("SELECT room_id, user_id, message FROM message")
@@ -696,10 +1896,153 @@ class ServerTest(TestCase):
         expected_rooms = {('room0', m[0]), ('room0', m[1]), ('room1', m[0]), ('room1', m[1])}
 
         self.assertEqual(expected_users, s.users.values())
+        self.assertEqual(1, s.users['Saar_Sayfan'].id)
+        self.assertEqual({'room0': 1, 'room1': 2},
+                         {r.name: r.id for r in s.rooms.values()})
         rooms = set()
+        end = datetime.utcnow() + timedelta(seconds=1)
         for r in s.rooms.values():
-            for m in r.messages.values():
-                rooms.add((r.name, m))
+            # History is only loaded on demand
+            self.assertEqual({}, r.blocks)
+            start_us, end_us = to_micros(start), to_micros(end)
+            for seq, t, sender, text in s.history.get_messages(r, start_us, end_us):
+                rooms.add((r.name, (s.users_by_id[sender].handle, text)))
 
         for r in expected_rooms:
-            self.assertIn(r, rooms)
\ No newline at end of file
+            self.assertIn(r, rooms)
+
+    def test_migrate_message_seq(self):
+        # A database from before sequence ids
+        db_file = os.path.abspath('old_rumble.db')
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        conn = sqlite3.connect(db_file)
+        with conn:
+            conn.executescript("""
+                CREATE TABLE room(id INTEGER PRIMARY KEY, name TEXT);
+                CREATE TABLE user(id INTEGER PRIMARY KEY, name TEXT, password TEXT, handle TEXT);
+                CREATE TABLE message(id INTEGER PRIMARY KEY, room_id references room(id),
+                                     user_id references user(id), timestamp TEXT, message TEXT);
+                INSERT INTO room (name) VALUES ('room0'), ('room1');
+                INSERT INTO user (name, password, handle) VALUES ('Saar_Sayfan', 'passwurd', 'Saar');
+                INSERT INTO message (room_id, user_id, timestamp, message) VALUES
+                    (1, 1, '2017-01-01 00:00:00', 'a'),
+                    (2, 1, '2017-01-01 00:00:01', 'b'),
+                    (1, 1, '2017-01-01 00:00:02', 'c');
+            """)
+        conn.close()
+
+        server.instance.disconnect()
+        server.instance = None
+        server.db_path = db_file
+        s = server.get_instance()
+
+        result = s.history.get_range(s.rooms['room0'], 1, 100)
+        self.assertEqual([(1, 'a'), (2, 'c')], [(m[0], m[3]) for m in result])
+        result = s.history.get_range(s.rooms['room1'], 1, 100)
+        self.assertEqual([(1, 'b')], [(m[0], m[3]) for m in result])
+
+        # Text timestamps were converted to microseconds since the epoch
+        conn = sqlite3.connect(db_file)
+        rows = conn.execute('SELECT typeof(timestamp), timestamp FROM message ORDER BY id').fetchall()
+        conn.close()
+        start = to_micros(datetime(2017, 1, 1))
+        self.assertEqual([('integer', start), ('integer', start + 1000000), ('integer', start + 2000000)],
+                         rows)
+        self.assertEqual(2, s.history.find_seq(s.rooms['room0'], start + 1))
+
+    def test_migrate_atomically(self):
+        db_file = os.path.abspath('old_rumble.db')
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        conn = sqlite3.connect(db_file)
+        with conn:
+            conn.executescript("""
+                CREATE TABLE room(id INTEGER PRIMARY KEY, name TEXT);
+                CREATE TABLE user(id INTEGER PRIMARY KEY, name TEXT, password TEXT, handle TEXT);
+                CREATE TABLE message(id INTEGER PRIMARY KEY, room_id references room(id),
+                                     user_id references user(id), timestamp TEXT, message TEXT,
+                                     seq INTEGER);
+                INSERT INTO room (name) VALUES ('room0');
+                INSERT INTO user (name, password, handle) VALUES ('Saar_Sayfan', 'passwurd', 'Saar');
+                INSERT INTO message (room_id, user_id, timestamp, message, seq) VALUES
+                    (1, 1, '2017-01-01 00:00:00', 'a', 1);
+                -- Left behind by a migration that crashed
+                CREATE TABLE message_new(id INTEGER PRIMARY KEY);
+            """)
+        conn.close()
+        server.instance.disconnect()
+        server.instance = None
+        server.db_path = db_file
+
+        # A migration that fails half way leaves the database as it was
+        with patch.dict(statements, rename_message_table='NOT SQL'):
+            self.assertRaises(sqlite3.OperationalError, server.get_instance)
+        server.instance = None
+        conn = sqlite3.connect(db_file)
+        self.assertEqual([('text', 'a')], conn.execute('SELECT typeof(timestamp), message FROM message').fetchall())
+        self.assertEqual([], conn.execute("SELECT name FROM sqlite_master WHERE name = 'membership'").fetchall())
+        conn.close()
+
+        s = server.get_instance()
+        result = s.history.get_range(s.rooms['room0'], 1, 100)
+        self.assertEqual([(1, to_micros(datetime(2017, 1, 1)), 'a')], [(m[0], m[1], m[3]) for m in result])
+
+    def test_parse_iso(self):
+        expected = to_micros(datetime(2017, 1, 2, 3, 4, 5, 678000))
+        self.assertEqual(expected, parse_iso('2017-01-02T03:04:05.678'))
+        self.assertEqual(expected, parse_iso('2017-01-02 03:04:05.678000'))
+        # Other formats fall back to dateutil
+        self.assertEqual(expected, parse_iso('Jan 2 2017 03:04:05.678'))
+        self.assertEqual(expected, parse_iso('2017-01-02T05:04:05.678+02:00'))
+        self.assertEqual(to_micros(datetime(2017, 1, 2)), parse_iso('2017-01-02'))
+        self.assertRaises(ValueError, parse_iso, '2017-02-30T00:00:00')
+
+    def test_block_timestamps(self):
+        block = Block()
+        timestamp = timeutil.now()
+        block.append(1, timestamp, 1, 'hi')
+        self.assertEqual([(1, timestamp, 1, 'hi')], block.get_range(1, 2))
+        self.assertIsInstance(block.get_range(1, 2)[0][1], (int, long))
+
+    def test_history_eviction(self):
+        auth = self._login_test_user()
+        self.test_app.post('/room/room0', headers=auth)
+        self.test_app.post('/room_member/room0', headers=auth)
+        s = server.get_instance()
+        for i in range(10):
+            s.handle_message(auth['Authorization'], 'room0', 'message {}'.format(i))
+
+        s.writer.flush()
+
+        # A fresh history of the same room, in blocks of 4 seqs
+        h = History(s.db, s.writer, block_size=4, max_messages=10)
+        room = Room('room0', {}, threading.RLock(), s.rooms['room0'].id)
+
+        def loads():
+            return s.get_db_stats()['select_history'][0]
+
+        # Missing blocks are loaded with a single query
+        result = h.get_range(room, 1, 8)
+        self.assertEqual(range(1, 8), [m[0] for m in result])
+        self.assertEqual('message 0', result[0][3])
+        self.assertEqual(1, loads())
+        self.assertEqual([0, 1], sorted(room.blocks))
+
+        # Resident blocks are served from memory
+        h.get_range(room, 4, 6)
+        self.assertEqual(1, loads())
+
+        # Loading a third block goes over budget and evicts the least
+        # recently used block first
+        result = h.get_range(room, 8, 100)
+        self.assertEqual([8, 9, 10], [m[0] for m in result])
+        self.assertEqual(2, loads())
+        self.assertEqual([1, 2], sorted(room.blocks))
+        self.assertTrue(h.size <= 10)
+
+        # Timestamps are found in resident blocks, or with a query
+        timestamps = [m[1] for m in s.history.get_range(s.rooms['room0'], 1, 11)]
+        self.assertEqual(5, h.find_seq(room, timestamps[4]))
+        self.assertEqual(2, h.find_seq(room, timestamps[1]))
+        self.assertEqual(11, h.find_seq(room, timestamps[9] + 1))